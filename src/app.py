@@ -1,40 +1,192 @@
 import os
 import sys
 import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from elasticsearch import Elasticsearch
+import config
+import profiling
 
-from dotenv import load_dotenv
-
-import pits
-import footprints
-import earthquakes
-import buildings
-
-logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s")
+logging.basicConfig(format="%(asctime)s - %(levelname)s - [%(threadName)s] %(message)s")
 logger = logging.getLogger("app")
 logger.setLevel(logging.INFO)
 
+PROCESS_PITS = True
+PROCESS_FOOTPRINTS = True
+PROCESS_EARTHQUAKES = True
+PROCESS_BUILDINGS = True
+EXPORT_DATA = False
+EXPORT_TILES = False
+
+# Seconds the merge step waits for the buildings shards
+MERGE_TIMEOUT = 3600
+# Seconds to wait for the buildings enrichment task
+TASK_TIMEOUT = 3600
+
+# Throttle for the buildings enrichment update by query (None to disable)
+BUILDINGS_REQUESTS_PER_SECOND = None
+
+STAGES = ["pits", "footprints", "earthquakes", "buildings"]
+# Modules imported by every stage
+STAGE_MODULES = {
+    "pits": ["pits"],
+    "footprints": ["footprints", "arrival"],
+    "earthquakes": ["earthquakes"],
+    "buildings": ["buildings"],
+}
+
+
+def shard_type(value):
+    """
+    Parses an i/n shard definition, with i from 1 to n
+    """
+    try:
+        shard, count = [int(v) for v in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"wrong shard [{value}], use i/n")
+    if not 1 <= shard <= count:
+        raise argparse.ArgumentTypeError(f"wrong shard [{value}], i must be from 1 to n")
+    return shard, count
+
+
+parser = argparse.ArgumentParser(description="Cumbre Vieja data publishing")
+parser.add_argument(
+    "--stages",
+    nargs="+",
+    choices=STAGES,
+    help="Stages to process, overrides the PROCESS_* variables",
+)
+parser.add_argument(
+    "--config",
+    help="Regions configuration file (also set with REGIONS_CONFIG)",
+)
+parser.add_argument(
+    "--regions",
+    nargs="+",
+    help="Names of the regions to process, all of them by default",
+)
+parser.add_argument(
+    "--shard",
+    type=shard_type,
+    help="Load only the i/n partition of the buildings, enrichment runs on the merge",
+)
+parser.add_argument(
+    "--merge-shards",
+    type=int,
+    metavar="N",
+    help="Wait for the N buildings shards, merge them and run the enrichment once",
+)
+parser.add_argument(
+    "--merge-timeout",
+    type=int,
+    default=MERGE_TIMEOUT,
+    metavar="SECONDS",
+    help=f"Seconds to wait for the shards to finish (default {MERGE_TIMEOUT})",
+)
+parser.add_argument(
+    "--task-timeout",
+    type=int,
+    default=TASK_TIMEOUT,
+    metavar="SECONDS",
+    help=f"Seconds to wait for the buildings enrichment task (default {TASK_TIMEOUT})",
+)
+parser.add_argument(
+    "--tiles",
+    action="store_true",
+    help="Export vector tiles of the processed footprints, quakes and buildings",
+)
+parser.add_argument(
+    "--local",
+    metavar="PATH",
+    help="Use a local SQLite store instead of Elasticsearch (also set with LOCAL_STORE)",
+)
+parser.add_argument(
+    "--profile",
+    choices=profiling.MODES,
+    help="Profile the stages (also set with the PROFILE environment variable)",
+)
+parser.add_argument(
+    "--dry-run",
+    action="store_true",
+    help="Load the configuration and the stage modules, then exit without connecting",
+)
+args = parser.parse_args()
+
+# The .env file can set the profiling mode and the regions file too
+from dotenv import load_dotenv  # noqa: E402
+
 load_dotenv()
 
-# Create the client
+if args.tiles:
+    EXPORT_TILES = True
+
+if args.shard and args.merge_shards:
+    parser.error("--shard and --merge-shards are exclusive")
+
+# Partitioned runs only process the buildings, so workers don't race
+# each other on the other stages
+if args.shard or args.merge_shards:
+    if args.stages and args.stages != ["buildings"]:
+        parser.error("--shard and --merge-shards only run the buildings stage")
+    args.stages = ["buildings"]
+
+if args.stages:
+    PROCESS_PITS = "pits" in args.stages
+    PROCESS_FOOTPRINTS = "footprints" in args.stages
+    PROCESS_EARTHQUAKES = "earthquakes" in args.stages
+    PROCESS_BUILDINGS = "buildings" in args.stages
+
+PROFILE = profiling.get_mode(args.profile)
+
+REGIONS = config.load_regions(args.config, args.regions)
+if len(REGIONS) == 0:
+    logger.critical("No regions to process")
+    sys.exit(1)
+
+if args.dry_run:
+    import importlib
+
+    enabled = {
+        "pits": PROCESS_PITS,
+        "footprints": PROCESS_FOOTPRINTS,
+        "earthquakes": PROCESS_EARTHQUAKES,
+        "buildings": PROCESS_BUILDINGS,
+    }
+    stages = [
+        stage
+        for stage in STAGES
+        if enabled[stage] and any(r["sources"].get(stage) for r in REGIONS)
+    ]
+    for stage in stages:
+        for module in STAGE_MODULES[stage]:
+            importlib.import_module(module)
+    if EXPORT_TILES:
+        importlib.import_module("tiles")
+    logger.info(f"Dry run of {len(REGIONS)} regions, stages: {', '.join(stages)}")
+    sys.exit(0)
+
+# Create the client. Stage modules and heavy dependencies are imported
+# only when needed
+LOCAL_STORE = args.local or os.getenv("LOCAL_STORE")
 ES_CLOUD_ID = os.getenv("ES_CLOUD_ID")
 ES_USER = os.getenv("ES_USER")
 ES_PASSWORD = os.getenv("ES_PASSWORD")
 
-if not (ES_CLOUD_ID and ES_PASSWORD and ES_USER):
+if LOCAL_STORE:
+    import localstore
+
+    logger.info(f"Sending data to local store: {LOCAL_STORE}")
+    es_client = localstore.get_client(LOCAL_STORE)
+elif not (ES_CLOUD_ID and ES_PASSWORD and ES_USER):
     logger.critical("Environment variables missing")
     sys.exit(1)
 else:
     logger.info(f"Sending data to cluster: {ES_CLOUD_ID}")
 
-es_client = Elasticsearch(cloud_id=ES_CLOUD_ID, http_auth=(ES_USER, ES_PASSWORD))
+    from elasticsearch import Elasticsearch
 
-PROCESS_PITS = True
-PROCESS_FOOTPRINTS = True
-PROCESS_EARTHQUAKES = True
-PROCESS_BUILDINGS = True
-EXPORT_DATA = False
+    es_client = Elasticsearch(cloud_id=ES_CLOUD_ID, http_auth=(ES_USER, ES_PASSWORD))
 
 """
 Reseting the cluster
@@ -45,58 +197,221 @@ DELETE eruptive_pits
 DELETE lapalma
 DELETE earthquakes
 DELETE lapalma_buildings
+DELETE lapalma_growth
 """
 
-if PROCESS_PITS:
-    logger.info("------------")
-    pits.upload_pits(es_client)
+
+def run_pits(region):
+    """
+    Uploads the eruptive pits
+    """
+    prefix = region["index_prefix"]
+    sources = region["sources"]
+
+    with profiling.profile(f"{region['name']}_pits", PROFILE):
+        import pits
+
+        logger.info("------------")
+        pits.upload_pits(es_client, prefix=prefix, url=sources["pits"])
+
+
+def run_footprints(region, layers):
+    """
+    Indexes the footprints, their arrival grid and growth series
+    """
+    prefix = region["index_prefix"]
+
+    with profiling.profile(f"{region['name']}_footprints", PROFILE):
+        # Footprints
+        import footprints
+        import arrival
+
+        profiling.install_hooks(PROFILE, [(footprints, "get_diffed_features")])
+
+        # Create the footprints index
+        footprints.create_footprints_index(es_client, prefix)
+
+        # Download the geojson objects
+        logger.info("------------")
+        logger.info("Downloading footprints data...")
+        features = footprints.download_footprints(
+            config.get_footprint_ids(region), prefix
+        )
+        logger.info(f"Retrieved {len(features)} footprints from the Open Data portal")
+
+        # Process the footprints to get the differences
+        diffed_features = footprints.get_diffed_features(features, prefix)
+
+        # Upload to ES
+        logger.info("Indexing the footprints...")
+
+        fp_results = footprints.index_footprints(
+            es_client, diffed_features, overwrite=False, prefix=prefix
+        )
+        logger.info(f"   indexed: {fp_results['indexed']}")
+        logger.info(f"   skipped: {fp_results['skipped']}")
+        logger.info(f"   errors:  {fp_results['errors']}")
+
+        # Keep the first affected footprint grid updated
+        arrival.update_grid(
+            diffed_features, prefix, config.to_bounds(region["eruption_bbox"])
+        )
+
+        # Precompute the lava growth time series
+        series = footprints.get_growth_series(diffed_features)
+        footprints.index_growth(es_client, series, prefix)
+
+        if EXPORT_DATA:
+            logger.info('Exporting footprints...')
+            footprints.export(diffed_features, prefix)
+
+        if EXPORT_TILES:
+            layers["footprints"] = list(
+                map(footprints.get_diff_footprint_feature, diffed_features)
+            )
+
+
+def run_earthquakes(region, layers):
+    """
+    Indexes the earthquakes
+    """
+    prefix = region["index_prefix"]
+
+    with profiling.profile(f"{region['name']}_earthquakes", PROFILE):
+        # Earthquakes
+        import earthquakes
+
+        profiling.install_hooks(PROFILE, [(earthquakes, "get_quake")])
+
+        logger.info("------------")
+        logger.info("Downloading quakes data...")
+        quakes = earthquakes.download_earthquakes(
+            region["bbox"],
+            region["start_date"] or earthquakes.START_DATE,
+            region["end_date"],
+        )
+        logger.info(f"Retrieved {len(quakes)} quake entries, indexing...")
+        earthquakes.index_quakes(es_client, quakes, prefix)
+
+        if EXPORT_DATA:
+            logger.info('Exporting quakes...')
+            earthquakes.export(quakes, prefix)
+
+        if EXPORT_TILES:
+            layers["earthquakes"] = list(map(earthquakes.get_geojson_feature, quakes))
+
+
+def run_buildings(region, layers):
+    """
+    Loads the buildings, as a whole or by shards, and enriches them
+    """
+    prefix = region["index_prefix"]
+    sources = region["sources"]
+
+    with profiling.profile(f"{region['name']}_buildings", PROFILE):
+        import buildings
+
+        profiling.install_hooks(
+            PROFILE, [(buildings, "get_docs"), (buildings, "get_actions")]
+        )
+
+        logger.info("------------")
+        logger.info("Processing buildings...")
+        bbox = config.to_bounding_box(region["eruption_bbox"])
+        docs = None
+        if args.shard:
+            shard, count = args.shard
+            buildings.index_buildings_shard(
+                es_client, shard, count, prefix=prefix, url=sources["buildings"]
+            )
+        elif args.merge_shards:
+            buildings.merge_shards(
+                es_client,
+                args.merge_shards,
+                requests_per_second=BUILDINGS_REQUESTS_PER_SECOND,
+                prefix=prefix,
+                bbox=bbox,
+                timeout=args.merge_timeout,
+                task_timeout=args.task_timeout,
+            )
+        else:
+            docs = buildings.index_buildings(
+                es_client,
+                requests_per_second=BUILDINGS_REQUESTS_PER_SECOND,
+                prefix=prefix,
+                url=sources["buildings"],
+                bbox=bbox,
+                task_timeout=args.task_timeout,
+            )
+
+        # Shards only hold part of the buildings, the merge exports them
+        if EXPORT_TILES and not args.shard:
+            if docs is None:
+                from data import download_geojson
+
+                features = download_geojson(sources["buildings"])
+                docs = buildings.get_docs(features, prefix)
+            layers["buildings"] = buildings.get_tile_features(docs, prefix)
+
+
+def run_tiles(region, layers):
+    """
+    Exports the vector tiles of the layers collected by the stages
+    """
+    with profiling.profile(f"{region['name']}_tiles", PROFILE):
+        import tiles
+
+        logger.info("------------")
+        logger.info("Exporting vector tiles...")
+        tiles.export_tiles(layers, region["eruption_bbox"], prefix=region["index_prefix"])
 
 
-if PROCESS_FOOTPRINTS:
-    # Footprints
+def run_region(region):
+    """
+    Runs all the stages of a region, sharing the client and HTTP cache
+    """
+    threading.current_thread().name = region["name"]
+    sources = region["sources"]
+    # GeoJSON features for the vector tiles, by layer
+    layers = {}
 
-    # Create the footprints index
-    footprints.create_footprints_index(es_client)
+    if PROCESS_PITS and sources.get("pits"):
+        run_pits(region)
 
-    # Download the geojson objects
-    logger.info("------------")
-    logger.info("Downloading footprints data...")
-    features = footprints.download_footprints()
-    logger.info(f"Retrieved {len(features)} footprints from the Open Data portal")
+    if PROCESS_FOOTPRINTS and sources.get("footprints"):
+        run_footprints(region, layers)
 
-    # Process the footprints to get the differences
-    diffed_features = footprints.get_diffed_features(features)
+    if PROCESS_EARTHQUAKES and sources.get("earthquakes"):
+        run_earthquakes(region, layers)
 
-    # Upload to ES
-    logger.info("Indexing the footprints...")
+    if PROCESS_BUILDINGS and sources.get("buildings"):
+        run_buildings(region, layers)
 
-    fp_results = footprints.index_footprints(es_client, diffed_features, overwrite=False)
-    logger.info(f"   indexed: {fp_results['indexed']}")
-    logger.info(f"   skipped: {fp_results['skipped']}")
-    logger.info(f"   errors:  {fp_results['errors']}")
+    if layers:
+        run_tiles(region, layers)
 
-    if EXPORT_DATA:
-        logger.info('Exporting footprints...')
-        footprints.export(diffed_features)
 
-if PROCESS_EARTHQUAKES:
+# Regions run in parallel, unless profiling as tracemalloc is process wide
+workers = 1 if PROFILE else len(REGIONS)
+with ThreadPoolExecutor(max_workers=workers) as executor:
+    # Raise any error from the regions
+    list(executor.map(run_region, REGIONS))
 
-    # Earthquakes
-    logger.info("------------")
-    logger.info("Downloading quakes data...")
-    quakes = earthquakes.download_earthquakes()
-    logger.info(f"Retrieved {len(quakes)} quake entries, indexing...")
-    earthquakes.index_quakes(es_client, quakes)
+# Geometries compaction stats, if any stage used it
+if "compaction" in sys.modules:
+    compaction = sys.modules["compaction"]
+    for name in compaction.stats:
+        compaction.log_stats(name)
 
-    if EXPORT_DATA:
-        logger.info('Exporting quakes...')
-        earthquakes.export(quakes)
+# Geometries repair stats and dropped features report
+if "repair" in sys.modules:
+    repair = sys.modules["repair"]
+    for name in repair.stats:
+        repair.log_stats(name)
+    repair.write_report()
 
-if PROCESS_BUILDINGS:
-    logger.info("------------")
-    logger.info("Processing buildings...")
-    buildings.index_buildings(es_client)
+logger.info("------------")
+logger.info("Process finished")
+logger.info("------------")
 
-    logger.info("------------")
-    logger.info("Process finished")
-    logger.info("------------")
+profiling.write_hooks_report()
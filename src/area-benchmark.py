@@ -0,0 +1,37 @@
+import time
+
+import numpy as np
+from area import area
+from shapely.geometry import shape, mapping
+
+from data import download_geojson
+from buildings import GEOJSON_URL
+from geoarea import areas, ABS_TOLERANCE, TOLERANCE
+
+# Compare the pure Python and the vectorized area on the full buildings layer
+print("Downloading the buildings layer...")
+features = download_geojson(GEOJSON_URL)
+geometries = [mapping(shape(f["geometry"]).buffer(0)) for f in features]
+print(f"{len(geometries)} buildings")
+
+start = time.perf_counter()
+expected = [area(g) for g in geometries]
+python_time = time.perf_counter() - start
+
+start = time.perf_counter()
+result = areas(geometries)
+numpy_time = time.perf_counter() - start
+
+max_error = max(
+    abs(r - e) / abs(e) if e else abs(r) for r, e in zip(result, expected)
+)
+
+print(f"area:     {python_time:.3f}s")
+print(f"geoarea:  {numpy_time:.3f}s ({python_time / numpy_time:.1f}x)")
+print(
+    f"max relative error: {max_error:.2e}"
+    f" (tolerance {TOLERANCE:.0e}, absolute {ABS_TOLERANCE:.0e} m2)"
+)
+
+if not np.allclose(result, expected, rtol=TOLERANCE, atol=ABS_TOLERANCE):
+    raise SystemExit("Vectorized areas do not match the area package!")
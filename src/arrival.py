@@ -0,0 +1,218 @@
+"""
+First affected footprint grid.
+
+Rasterizes the ordered footprint diffs into a memory mapped array over
+the eruption area. Every cell stores the index of the first footprint
+that covered it (or -1), so points and buildings can be classified with
+an array lookup instead of a spatial query.
+"""
+import json
+import logging
+
+import numpy as np
+
+from data import get_cache_path
+
+logger = logging.getLogger("app")
+
+GRID_FILE = "lapalma_arrival.npy"
+META_FILE = "lapalma_arrival.json"
+
+# Eruption area and cell size in degrees (~10 meters)
+BBOX = {"min_lon": -17.95, "min_lat": 28.58, "max_lon": -17.83, "max_lat": 28.647}
+RESOLUTION = 0.0001
+
+EMPTY = -1
+
+
+def get_shape(bbox=BBOX, resolution=RESOLUTION):
+    rows = int(np.ceil((bbox["max_lat"] - bbox["min_lat"]) / resolution))
+    cols = int(np.ceil((bbox["max_lon"] - bbox["min_lon"]) / resolution))
+    return rows, cols
+
+
+def load_meta(prefix=""):
+    try:
+        with open(get_cache_path(prefix + META_FILE)) as reader:
+            return json.load(reader)
+    except (OSError, ValueError):
+        return None
+
+
+def save_meta(meta, prefix=""):
+    with open(get_cache_path(prefix + META_FILE), "w") as writer:
+        json.dump(meta, writer)
+
+
+def open_grid(mode="r+", prefix=""):
+    return np.load(get_cache_path(prefix + GRID_FILE), mmap_mode=mode)
+
+
+def create_grid(bbox=BBOX, resolution=RESOLUTION, prefix=""):
+    """
+    Creates an empty grid on disk and returns it with its metadata
+    """
+    grid = np.lib.format.open_memmap(
+        get_cache_path(prefix + GRID_FILE),
+        mode="w+",
+        dtype=np.int16,
+        shape=get_shape(bbox, resolution),
+    )
+    grid[:] = EMPTY
+    meta = {"bbox": bbox, "resolution": resolution, "footprints": []}
+    return grid, meta
+
+
+def get_rings(geometry):
+    g_type = geometry["type"]
+    if g_type == "Polygon":
+        return geometry["coordinates"]
+    elif g_type == "MultiPolygon":
+        return [ring for polygon in geometry["coordinates"] for ring in polygon]
+    elif g_type == "GeometryCollection":
+        return [ring for g in geometry["geometries"] for ring in get_rings(g)]
+    return []
+
+
+def rasterize(geometry, bbox, resolution, shape):
+    """
+    Returns a boolean mask of the cells whose center falls inside the
+    geometry, using an even-odd scanline fill so holes are respected
+    """
+    rows, cols = shape
+    mask = np.zeros(shape, dtype=bool)
+
+    edges = []
+    for ring in get_rings(geometry):
+        ring = np.asarray([c[:2] for c in ring], dtype=np.float64)
+        if len(ring) > 2:
+            edges.append(np.hstack([ring[:-1], ring[1:]]))
+    if len(edges) == 0:
+        return mask
+    edges = np.vstack(edges)
+
+    # Cell coordinates relative to the grid, in cell units
+    x0 = (edges[:, 0] - bbox["min_lon"]) / resolution
+    y0 = (edges[:, 1] - bbox["min_lat"]) / resolution
+    x1 = (edges[:, 2] - bbox["min_lon"]) / resolution
+    y1 = (edges[:, 3] - bbox["min_lat"]) / resolution
+
+    row_min = max(int(np.floor(min(y0.min(), y1.min()))), 0)
+    row_max = min(int(np.ceil(max(y0.max(), y1.max()))), rows)
+
+    for row in range(row_min, row_max):
+        y = row + 0.5
+        crossing = (y0 <= y) != (y1 <= y)
+        if not crossing.any():
+            continue
+        xs = x0[crossing] + (y - y0[crossing]) * (x1[crossing] - x0[crossing]) / (
+            y1[crossing] - y0[crossing]
+        )
+        xs.sort()
+        for start, end in zip(xs[0::2], xs[1::2]):
+            col_start = max(int(np.ceil(start - 0.5)), 0)
+            col_end = min(int(np.floor(end - 0.5)) + 1, cols)
+            if col_start < col_end:
+                mask[row, col_start:col_end] = True
+
+    return mask
+
+
+def update_grid(diffed_features, prefix="", bbox=BBOX):
+    """
+    Rasterizes the footprints not yet in the grid. The grid is rebuilt
+    if a new footprint is older than the last rasterized one.
+    """
+    features = sorted(diffed_features, key=lambda f: f["timestamp"])
+    meta = load_meta(prefix)
+
+    try:
+        grid = open_grid(prefix=prefix) if meta is not None else None
+    except (OSError, ValueError):
+        grid = None
+
+    if grid is not None and meta["bbox"] != bbox:
+        logger.info("Arrival grid area changed, rebuilding it")
+        grid = None
+
+    if grid is not None:
+        done = {f["id"] for f in meta["footprints"]}
+        pending = [f for f in features if f["id"] not in done]
+        last = meta["footprints"][-1]["timestamp"] if meta["footprints"] else None
+        if last is not None and any(f["timestamp"] < last for f in pending):
+            logger.info("Older footprints found, rebuilding the arrival grid")
+            grid = None
+
+    if grid is None:
+        grid, meta = create_grid(bbox, prefix=prefix)
+        pending = features
+
+    if len(pending) == 0:
+        logger.info("Arrival grid up to date")
+        return 0
+
+    if len(meta["footprints"]) + len(pending) > np.iinfo(grid.dtype).max:
+        raise Exception("Too many footprints for the arrival grid")
+
+    for feature in pending:
+        idx = len(meta["footprints"])
+        mask = rasterize(
+            feature["diff_geometry"], meta["bbox"], meta["resolution"], grid.shape
+        )
+        # Only claim the cells not covered by a previous footprint
+        mask &= grid == EMPTY
+        grid[mask] = idx
+        meta["footprints"].append({"id": feature["id"], "timestamp": feature["timestamp"]})
+        logger.debug(f"[{feature['id']}] {mask.sum()} new cells")
+
+    grid.flush()
+    save_meta(meta, prefix)
+    logger.info(f"Arrival grid updated with {len(pending)} footprints")
+
+    return len(pending)
+
+
+def lookup(lons, lats, prefix=""):
+    """
+    Returns the index of the first footprint covering every point
+    or -1 if not covered or outside the grid
+    """
+    meta = load_meta(prefix)
+    if meta is None:
+        raise Exception("Arrival grid not found, process the footprints first")
+
+    grid = open_grid(mode="r", prefix=prefix)
+    bbox = meta["bbox"]
+    resolution = meta["resolution"]
+
+    cols = np.floor((np.asarray(lons) - bbox["min_lon"]) / resolution).astype(np.int64)
+    rows = np.floor((np.asarray(lats) - bbox["min_lat"]) / resolution).astype(np.int64)
+    inside = (rows >= 0) & (rows < grid.shape[0]) & (cols >= 0) & (cols < grid.shape[1])
+
+    result = np.full(rows.shape, EMPTY, dtype=np.int64)
+    result[inside] = grid[rows[inside], cols[inside]]
+
+    return result
+
+
+def get_arrivals(points, prefix=""):
+    """
+    Returns the first footprint (id and timestamp) covering every
+    (lon, lat) point or None
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if len(points) == 0:
+        return []
+
+    # Fails first if the grid was never built
+    indices = lookup(points[:, 0], points[:, 1], prefix)
+    footprints = load_meta(prefix)["footprints"]
+
+    return [footprints[idx] if idx != EMPTY else None for idx in indices]
+
+
+def get_building_arrivals(buildings, prefix=""):
+    """
+    Classifies buildings documents by the first footprint covering their centroid
+    """
+    return get_arrivals([b["centroid"]["coordinates"] for b in buildings], prefix)
@@ -1,9 +1,12 @@
+import hashlib
 import logging
+import time
 import warnings
+import zlib
 
+import journal
 from data import download_geojson
 
-from elasticsearch.helpers import bulk
 from elasticsearch.client import IndicesClient
 from elasticsearch.client.enrich import EnrichClient
 from elasticsearch.client.ingest import IngestClient
@@ -12,12 +15,13 @@ from elasticsearch.exceptions import NotFoundError
 from elasticsearch.exceptions import RequestError
 
 from shapely.geometry import shape, mapping
-from area import area
+from geoarea import areas
+from compaction import compact
+from repair import repair_all
 
 warnings.filterwarnings("ignore")
 logging.getLogger("elasticsearch").setLevel(logging.ERROR)
 
-logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger("app")
 
 INDEX_NAME = "lapalma_buildings"
@@ -25,37 +29,130 @@ GEOJSON_URL = (
     "https://opendata.arcgis.com/datasets/1c93601970fb41b480599c54fff25e4f_0.geojson"
 )
 
+# Checkpoint journal name for the buildings load
+JOURNAL_STAGE = "buildings"
+# Stats of every shard of a partitioned load
+SHARDS_INDEX = "lapalma_buildings_shards"
+# Seconds to wait for all the shards to finish before merging them
+MERGE_TIMEOUT = 3600
+# Number of buildings per vectorized area computation
+AREA_CHUNK_SIZE = 5000
+# Index to persist the enrichment state between runs, as CI runners
+# do not keep the user cache directory
+STATE_INDEX = "lapalma_buildings_state"
+# State document with the running update by query task
+TASK_STATE = "task"
+# State document with the footprints fingerprint used by the last enrichment
+FOOTPRINTS_STATE = "footprints"
+# State document written when a buildings load completes
+LOAD_STATE = "load"
+# Seconds between calls to the tasks API
+POLL_INTERVAL = 10
+# Seconds to wait for the enrichment task, checked again on the next run
+TASK_TIMEOUT = 3600
+FOOTPRINTS_INDEX = "lapalma"
+POLICY_NAME = "lapalma_lookup"
+PIPELINE_NAME = "buildings_footprints"
+# Eruption area, used when there is no previous fingerprint to compare with
+DEFAULT_BBOX = {
+    "top_left": {"lat": 28.647, "lon": -17.95},
+    "bottom_right": {"lat": 28.58, "lon": -17.83},
+}
 
-def get_actions(features):
+
+def get_doc(feature, s_geom, prefix=""):
+    properties = feature["properties"]
+
+    id = properties["OBJECTID"]
+
+    return {
+        "id": id,
+        "geometry": compact(mapping(s_geom), prefix + "buildings"),
+        "centroid": compact(mapping(s_geom.centroid), prefix + "centroids"),
+        "level": properties["LEVEL_"],
+        "name": properties["LNAME"],
+        "floors": properties["NUM_PLANTA"],
+    }
+
+
+def get_docs(features, prefix=""):
+    """
+    Returns the buildings documents, repairing only the invalid
+    geometries in a single batch and dropping the unfixable ones
+    """
+    shapes = []
     for feature in features:
         try:
-            properties = feature["properties"]
-            geometry = feature["geometry"]
+            shapes.append((feature, shape(feature["geometry"])))
+        except Exception as e:
+            logger.error(f"[{type(e)}] - {e}")
+
+    repaired = repair_all(
+        (s_geom for _, s_geom in shapes),
+        prefix + "buildings",
+        (feature["properties"].get("OBJECTID") for feature, _ in shapes),
+    )
+
+    docs = []
+    for (feature, _), s_geom in zip(shapes, repaired):
+        if s_geom is None:
+            continue
+        try:
+            docs.append(get_doc(feature, s_geom, prefix))
+        except Exception as e:
+            logger.error(f"[{type(e)}] - {e}")
+    return docs
+
 
-            id = properties["OBJECTID"]
-            s_geom = shape(geometry).buffer(0)
-            centroid = mapping(s_geom.centroid)
-            gejoson_geom = mapping(s_geom)
-            geom_area = int(area(gejoson_geom))
+def get_actions(docs, chunk_size=AREA_CHUNK_SIZE, index_name=INDEX_NAME, run=None):
+    # Compute the areas of each chunk of buildings in a single call
+    for start in range(0, len(docs), chunk_size):
+        chunk = docs[start:start + chunk_size]
+        chunk_areas = areas(doc["geometry"] for doc in chunk)
 
+        for doc, geom_area in zip(chunk, chunk_areas):
+            geom_area = int(geom_area)
             if geom_area > 0:
-                doc = {
-                    "id": id,
-                    "geometry": gejoson_geom,
-                    "centroid": centroid,
-                    "area": geom_area,
-                    "level": properties["LEVEL_"],
-                    "name": properties["LNAME"],
-                    "floors": properties["NUM_PLANTA"],
-                }
+                doc["area"] = geom_area
+                if run is not None:
+                    doc["run"] = run
                 yield {
-                    "_index": INDEX_NAME,
+                    "_index": index_name,
                     "_op_type": "index",
-                    "_id": str(id),
+                    "_id": str(doc["id"]),
                     "_source": doc,
                 }
-        except Exception as e:
-            logger.error(f"[{type(e)}] - {e}")
+
+
+def get_tile_features(docs, prefix=""):
+    """
+    Returns the buildings documents as GeoJSON features for the vector
+    tiles, with the first footprint covering them from the arrival grid
+    """
+    import arrival
+
+    try:
+        arrivals = arrival.get_building_arrivals(docs, prefix)
+    except Exception as e:
+        logger.warning(f"No arrival grid for the buildings tiles: {e}")
+        arrivals = [None] * len(docs)
+
+    return [
+        {
+            "type": "Feature",
+            "id": doc["id"],
+            "geometry": doc["geometry"],
+            "properties": {
+                "id": doc["id"],
+                "name": doc["name"],
+                "level": doc["level"],
+                "floors": doc["floors"],
+                "footprint_id": first["id"] if first else None,
+                "footprint_timestamp": first["timestamp"] if first else None,
+            },
+        }
+        for doc, first in zip(docs, arrivals)
+    ]
 
 
 def create_index(client, index_name):
@@ -73,6 +170,7 @@ def create_index(client, index_name):
                     "level": {"type": "integer"},
                     "name": {"type": "keyword"},
                     "floors": {"type": "integer"},
+                    "run": {"type": "keyword"},
                 }
             },
         )
@@ -82,47 +180,60 @@ def create_index(client, index_name):
         logger.info("Index already exists, continuing")
 
 
-def create_policy(client):
+def create_policy(client, execute=True, prefix=""):
+    """
+    Ensures the enrich policy exists and executes it if needed.
+    Returns False if the execution failed.
+    """
+    policy_name = prefix + POLICY_NAME
     enrich_client = EnrichClient(client)
     try:
-        policy = enrich_client.get_policy(name="lapalma_lookup")
+        policy = enrich_client.get_policy(name=policy_name)
         if len(policy['policies']) == 0:
             raise NotFoundError
     except NotFoundError:
-        logger.debug("Creating the lapalma_lookup policy")
+        # A new policy always needs to be executed
+        execute = True
+        logger.debug(f"Creating the {policy_name} policy")
         enrich_client.put_policy(
-            name="lapalma_lookup",
+            name=policy_name,
             body={
                 "geo_match": {
-                    "indices": "lapalma",
+                    "indices": prefix + FOOTPRINTS_INDEX,
                     "match_field": "diff_geometry",
                     "enrich_fields": ["id", "timestamp"],
                 }
             },
         )
 
+    if not execute:
+        logger.info("Footprints unchanged, skipping the enrich policy execution")
+        return True
+
     # Execute the policy
     logger.info("Updating the enrich policy...")
 
     try:
-        enrich_client.execute_policy(name="lapalma_lookup")
+        enrich_client.execute_policy(name=policy_name)
     except TransportError as e:
         logger.error(e)
+        return False
 
     logger.info("Done!")
+    return True
 
 
-def create_ingest_pipeline(ingest_client):
+def create_ingest_pipeline(ingest_client, prefix=""):
     logger.debug("Creating the enrich pipeline")
     ingest_client.put_pipeline(
-        id="buildings_footprints",
+        id=prefix + PIPELINE_NAME,
         body={
             "description": "Enrich buildings with Cumbre Vieja footprints.",
             "processors": [
                 {
                     "enrich": {
                         "field": "geometry",
-                        "policy_name": "lapalma_lookup",
+                        "policy_name": prefix + POLICY_NAME,
                         "target_field": "footprints",
                         "shape_relation": "INTERSECTS",
                         "ignore_missing": True,
@@ -142,66 +253,576 @@ def create_ingest_pipeline(ingest_client):
     )
 
 
-def index_buildings(client, overwrite=False):
+def create_state_index(client, prefix=""):
+    if not client.indices.exists(index=prefix + STATE_INDEX):
+        client.indices.create(
+            index=prefix + STATE_INDEX,
+            settings={"number_of_shards": 1, "number_of_replicas": 1},
+            # State documents are only read back by id
+            mappings={"dynamic": False, "properties": {}},
+        )
+
+
+def load_state(client, name, prefix=""):
+    """
+    Returns a state document or None
+    """
+    try:
+        return client.get(index=prefix + STATE_INDEX, id=name)["_source"]
+    except NotFoundError:
+        return None
+
+
+def save_state(client, name, state, prefix=""):
+    create_state_index(client, prefix)
+    client.index(index=prefix + STATE_INDEX, id=name, document=state, refresh=True)
+
+
+def clear_state(client, name, prefix=""):
+    try:
+        client.delete(index=prefix + STATE_INDEX, id=name, refresh=True)
+    except NotFoundError:
+        pass
+
+
+def get_footprints_state(client, prefix=""):
+    """
+    Returns the ids, max timestamp and a fingerprint of the footprints index
+    """
+    response = client.search(
+        index=prefix + FOOTPRINTS_INDEX,
+        body={"size": 1000, "_source": ["timestamp"], "query": {"match_all": {}}},
+    )
+    hits = response["hits"]["hits"]
+    ids = sorted(hit["_id"] for hit in hits)
+    timestamps = [hit["_source"]["timestamp"] for hit in hits]
+    max_timestamp = max(timestamps) if timestamps else None
+
+    fingerprint = hashlib.sha1(
+        "|".join(ids + [str(max_timestamp)]).encode("utf-8")
+    ).hexdigest()
+
+    return {"fingerprint": fingerprint, "ids": ids, "max_timestamp": max_timestamp}
+
+
+def load_footprints_state(client, prefix=""):
+    return load_state(client, FOOTPRINTS_STATE, prefix)
+
+
+def save_footprints_state(client, state, prefix=""):
+    save_state(client, FOOTPRINTS_STATE, state, prefix)
+
+
+def get_diffs_bbox(client, ids, prefix=""):
+    """
+    Returns the bounding box of the diff geometries of the given footprints
+    """
+    response = client.mget(
+        index=prefix + FOOTPRINTS_INDEX, body={"ids": ids}, _source=["diff_geometry"]
+    )
+    bounds = [
+        shape(doc["_source"]["diff_geometry"]).bounds
+        for doc in response["docs"]
+        if doc.get("found") and doc["_source"].get("diff_geometry")
+    ]
+    if len(bounds) == 0:
+        return None
+
+    return {
+        "top_left": {
+            "lat": max(b[3] for b in bounds),
+            "lon": min(b[0] for b in bounds),
+        },
+        "bottom_right": {
+            "lat": min(b[1] for b in bounds),
+            "lon": max(b[2] for b in bounds),
+        },
+    }
+
+
+def load_task(client, prefix=""):
+    """
+    Returns the persisted update by query task id, if any
+    """
+    state = load_state(client, TASK_STATE, prefix)
+    return state.get("task") if state else None
+
+
+def save_task(client, task_id, prefix=""):
+    save_state(client, TASK_STATE, {"task": task_id, "started": time.time()}, prefix)
+
+
+def clear_task(client, prefix=""):
+    clear_state(client, TASK_STATE, prefix)
+
+
+def get_task(client, task_id):
+    """
+    Gets the task from the tasks API or None if the cluster does not know it
+    """
+    try:
+        return client.tasks.get(task_id=task_id)
+    except NotFoundError:
+        return None
+
+
+def log_task_status(task):
+    status = task["task"]["status"]
+    done = status["updated"] + status["noops"] + status["deleted"]
+    logger.info(f"   {done}/{status['total']} buildings processed")
+
+
+def log_task_response(task):
+    response = task.get("response", {})
+    took = response.get("took", 0) / 1000
+    updated = response.get("updated", 0)
+    failures = response.get("failures", [])
+    rate = updated / took if took > 0 else 0
+
+    logger.info(f"   updated:  {updated}")
+    logger.info(f"   took:     {took:.1f}s ({rate:.1f} docs/s)")
+    logger.info(f"   failures: {len(failures)}")
+    for failure in failures:
+        logger.error(f"[{failure.get('id')}] - {failure.get('cause')}")
+
+    if "error" in task:
+        logger.error(f"Task failed: {task['error']}")
+
+    return response
+
+
+def wait_for_task(
+    client, task_id, timeout=TASK_TIMEOUT, poll_interval=POLL_INTERVAL, prefix=""
+):
+    """
+    Polls the tasks API until the task finishes and reports the result.
+    Returns None if the task was lost, timed out or did not update all
+    the buildings. A timed out task is kept for the next run to check.
+    """
+    deadline = time.time() + timeout
+    while True:
+        task = get_task(client, task_id)
+        if task is None:
+            logger.warning(f"Task [{task_id}] not found in the cluster")
+            clear_task(client, prefix)
+            return None
+        if task["completed"]:
+            break
+        log_task_status(task)
+        if time.time() >= deadline:
+            logger.warning(
+                f"Task [{task_id}] still running after {timeout}s,"
+                " checking it on the next run"
+            )
+            return None
+        time.sleep(poll_interval)
+
+    logger.info(f"Task [{task_id}] completed")
+    clear_task(client, prefix)
+    response = log_task_response(task)
+    if "error" in task or response.get("failures"):
+        return None
+    return response
+
+
+def check_previous_task(client, prefix=""):
+    """
+    Returns True if an update by query from a previous run is still running.
+    Finished tasks are reported and forgotten.
+    """
+    task_id = load_task(client, prefix)
+    if task_id is None:
+        return False
+
+    task = get_task(client, task_id)
+    if task is None:
+        logger.debug(f"Previous task [{task_id}] not found, forgetting it")
+        clear_task(client, prefix)
+        return False
+
+    if not task["completed"]:
+        logger.warning(f"Previous task [{task_id}] is still running")
+        log_task_status(task)
+        return True
+
+    logger.info(f"Previous task [{task_id}] completed")
+    log_task_response(task)
+    clear_task(client, prefix)
+    return False
+
+
+def enrich_buildings(
+    client,
+    bbox=DEFAULT_BBOX,
+    requests_per_second=None,
+    wait=True,
+    prefix="",
+    timeout=TASK_TIMEOUT,
+):
     """
-    Creates and populates an index with the buildings
+    Reruns the enrich pipeline on the buildings without a footprint
+    with a sliced update by query tracked through the tasks API
     """
+    if check_previous_task(client, prefix):
+        logger.info("Not starting a new update by query")
+        return None
+
+    # Just reindex buildings inside the bouinding box without a footpirnt ID
+    update_query = {
+        "query": {
+            "bool": {
+                "must_not": [{"exists": {"field": "footprints.id"}}],
+                "filter": {"geo_bounding_box": {"geometry": bbox}},
+            }
+        }
+    }
+
+    count_obj = client.count(body=update_query, index=prefix + INDEX_NAME)
+    count = count_obj.get("count", 0)
+    if count == 0:
+        logger.info("No buildings to update")
+        return {"total": 0, "updated": 0, "failures": []}
+
+    logger.info(f"Reindexing {count} buildings without a footprint id...")
+    params = {"slices": "auto"}
+    if requests_per_second is not None:
+        params["requests_per_second"] = requests_per_second
+
+    response = client.update_by_query(
+        prefix + INDEX_NAME,
+        body=update_query,
+        pipeline=prefix + PIPELINE_NAME,
+        wait_for_completion=False,
+        **params,
+    )
+    task_id = response["task"]
+    save_task(client, task_id, prefix)
+    logger.info(f"Update by query task [{task_id}] started")
+
+    if wait:
+        return wait_for_task(client, task_id, timeout, prefix=prefix)
+
+
+def prepare_enrichment(client, prefix=""):
+    """
+    Ensures the enrich policy, refreshed only when the footprints changed,
+    and the ingest pipeline exist. Returns the footprints states or None
+    if a previous enrichment is still running or the policy failed.
+    Without a footprints index the states are empty and the buildings
+    are loaded without enrichment.
+    """
+    if check_previous_task(client, prefix):
+        logger.info("Previous enrichment still running, skipping the buildings")
+        return None
+
+    if not client.indices.exists(index=prefix + FOOTPRINTS_INDEX):
+        logger.warning("No footprints index, the buildings won't be enriched")
+        return None, None, False
+
+    state = get_footprints_state(client, prefix)
+    previous_state = load_footprints_state(client, prefix)
+    changed = (
+        previous_state is None
+        or previous_state.get("fingerprint") != state["fingerprint"]
+    )
 
     # Ensure the policy exists an it's updated
-    create_policy(client)
+    if not create_policy(client, execute=changed, prefix=prefix):
+        # Force a full enrichment once the policy can be executed
+        clear_state(client, FOOTPRINTS_STATE, prefix)
+        logger.error("Enrich policy execution failed, skipping the buildings")
+        return None
 
     # Ensure the pipeline exists
     ingest_client = IngestClient(client)
     try:
-        ingest_client.get_pipeline(id="buildings_footprints")
+        ingest_client.get_pipeline(id=prefix + PIPELINE_NAME)
     except NotFoundError:
-        create_ingest_pipeline(ingest_client)
+        create_ingest_pipeline(ingest_client, prefix)
+
+    return state, previous_state, changed
+
+
+def finish_enrichment(
+    client,
+    states,
+    loaded,
+    requests_per_second=None,
+    prefix="",
+    bbox=DEFAULT_BBOX,
+    task_timeout=TASK_TIMEOUT,
+):
+    """
+    Enriches the buildings in the area of the new footprints, or all
+    of them if they were just loaded
+    """
+    state, previous_state, changed = states
+
+    if state is None:
+        return
+
+    if not (changed or loaded):
+        logger.info("No new footprints, skipping the buildings enrichment")
+        return
+
+    # Restrict the enrichment to the area of the new footprints
+    if previous_state is not None and not loaded:
+        new_ids = sorted(set(state["ids"]) - set(previous_state.get("ids", [])))
+        bbox = get_diffs_bbox(client, new_ids, prefix) if new_ids else bbox
+        if bbox is None:
+            logger.info("New footprints have no diff geometry, nothing to enrich")
+            save_footprints_state(client, state, prefix)
+            return
+        logger.debug(f"Enriching {len(new_ids)} new footprints area: {bbox}")
+
+    response = enrich_buildings(
+        client,
+        bbox=bbox,
+        requests_per_second=requests_per_second,
+        prefix=prefix,
+        timeout=task_timeout,
+    )
+    # Only a completed enrichment makes the footprints state current,
+    # otherwise the next run enriches all the buildings again
+    if response is None:
+        logger.warning("Buildings enrichment not completed, retrying on the next run")
+        clear_state(client, FOOTPRINTS_STATE, prefix)
+        return
+    save_footprints_state(client, state, prefix)
+
+
+def load_buildings(client, docs, index_name, journal_stage, run=None):
+    # Bulk upload the records
+    logger.info(f"Uploading to ES {len(docs)} records...")
+    actions = get_actions(docs, index_name=index_name, run=run)
+    results = journal.bulk(client, journal_stage, actions, run_id=run)
+    logger.info(f"   indexed: {results['indexed']}")
+    logger.info(f"   skipped: {results['skipped']}")
+    logger.info(f"   errors:  {results['errors']}")
+    return results
+
+
+def index_buildings(
+    client,
+    overwrite=False,
+    requests_per_second=None,
+    prefix="",
+    url=GEOJSON_URL,
+    bbox=DEFAULT_BBOX,
+    task_timeout=TASK_TIMEOUT,
+):
+    """
+    Creates and populates an index with the buildings. Returns the
+    loaded documents, or None when the buildings were not loaded.
+    """
+    index_name = prefix + INDEX_NAME
+    journal_stage = prefix + JOURNAL_STAGE
+
+    states = prepare_enrichment(client, prefix)
+    if states is None:
+        return None
 
     # Create or overwrite the index
-    exists = IndicesClient(client).exists(INDEX_NAME)
+    exists = IndicesClient(client).exists(index_name)
+
+    # Resume an interrupted load unless starting from scratch. A load
+    # that failed before its journal started has no load state either.
+    resume = (
+        exists
+        and not overwrite
+        and (
+            journal.is_pending(journal_stage)
+            or load_state(client, LOAD_STATE, prefix) is None
+        )
+    )
 
     if exists and overwrite:
-        client.indices.delete(index=INDEX_NAME)
+        client.indices.delete(index=index_name)
 
     if not exists or overwrite:
-        create_index(client, INDEX_NAME)
+        journal.complete(journal_stage)
+        clear_state(client, LOAD_STATE, prefix)
+        create_index(client, index_name)
 
+    # Freshly loaded buildings need the full enrichment
+    loaded = not exists or overwrite or resume
+    docs = None
+    if loaded:
         logger.info("Getting the buildings data...")
-        features = download_geojson(GEOJSON_URL)
+        features = download_geojson(url)
         logger.debug(f"{len(features)} buildings downloaded")
+        docs = get_docs(features, prefix)
+        results = load_buildings(client, docs, index_name, journal_stage)
+        if results["errors"] == 0:
+            save_state(client, LOAD_STATE, {"completed": time.time()}, prefix)
 
-        # Bulk upload the records
-        logger.info(f"Uploading to ES {len(features)} records...")
-        bulk(client, get_actions(features))
+    finish_enrichment(
+        client, states, loaded, requests_per_second, prefix, bbox, task_timeout
+    )
+    return docs
 
-    # Just reindex buildings inside the bouinding box without a footpirnt ID
-    update_query = {
-        "query": {
-            "bool": {
-                "must_not": [{"exists": {"field": "footprints.id"}}],
-                "filter": {
-                    "geo_bounding_box": {
-                        "geometry": {
-                            "top_left": {"lat": 28.647, "lon": -17.95},
-                            "bottom_right": {"lat": 28.58, "lon": -17.83},
-                        }
-                    }
-                },
-            }
-        }
+
+def get_shard(id, count):
+    """
+    Deterministic shard of a building from its OBJECTID
+    """
+    return zlib.crc32(str(id).encode("utf-8")) % count
+
+
+def create_shards_index(client, prefix=""):
+    if not client.indices.exists(index=prefix + SHARDS_INDEX):
+        client.indices.create(
+            index=prefix + SHARDS_INDEX,
+            settings={"number_of_shards": 1, "number_of_replicas": 1},
+            mappings={
+                "properties": {
+                    "shard": {"type": "integer"},
+                    "count": {"type": "integer"},
+                    "indexed": {"type": "long"},
+                    "skipped": {"type": "long"},
+                    "errors": {"type": "long"},
+                    "run": {"type": "keyword"},
+                    "timestamp": {"type": "date"},
+                }
+            },
+        )
+
+
+def index_buildings_shard(client, shard, count, prefix="", url=GEOJSON_URL):
+    """
+    Loads only the buildings of one shard (1 to count) and records
+    its stats for the merge step. Buildings are tagged with the shard
+    run so the merge removes the ones no shard loaded. Enrichment runs
+    on the merge.
+    """
+    index_name = prefix + INDEX_NAME
+    journal_stage = f"{prefix}{JOURNAL_STAGE}_{shard}of{count}"
+    shard_id = f"{shard}of{count}"
+
+    create_index(client, index_name)
+    create_shards_index(client, prefix)
+
+    try:
+        client.get(index=prefix + SHARDS_INDEX, id=shard_id)
+        logger.info(f"Shard {shard}/{count} already loaded, skipping")
+        return None
+    except NotFoundError:
+        pass
+
+    # A resumed shard keeps the run of its pending journal
+    pending = journal.load(journal_stage)
+    run = pending["run"] if pending else journal.new_run_id()
+    # Indices created before the run tagging
+    client.indices.put_mapping(
+        index=index_name, body={"properties": {"run": {"type": "keyword"}}}
+    )
+
+    logger.info("Getting the buildings data...")
+    features = download_geojson(url)
+    features = [
+        f for f in features if get_shard(f["properties"]["OBJECTID"], count) == shard - 1
+    ]
+    logger.info(f"Shard {shard}/{count} with {len(features)} buildings")
+
+    docs = get_docs(features, prefix)
+    results = load_buildings(client, docs, index_name, journal_stage, run)
+    if results["errors"] > 0:
+        logger.warning(f"Shard {shard}/{count} not completed, run it again")
+        return results
+
+    results.update(
+        {"shard": shard, "count": count, "run": run, "timestamp": time.time() * 1000}
+    )
+    client.index(index=prefix + SHARDS_INDEX, id=shard_id, document=results, refresh=True)
+
+    return results
+
+
+def get_finished_shards(client, count, prefix=""):
+    response = client.search(
+        index=prefix + SHARDS_INDEX,
+        body={"size": count, "query": {"term": {"count": count}}},
+    )
+    return [hit["_source"] for hit in response["hits"]["hits"]]
+
+
+def wait_for_shards(
+    client, count, timeout=MERGE_TIMEOUT, poll_interval=POLL_INTERVAL, prefix=""
+):
+    """
+    Polls the shards stats until all of them finished, returning them,
+    or None after the timeout in seconds
+    """
+    create_shards_index(client, prefix)
+    start = time.time()
+    while True:
+        shards = get_finished_shards(client, count, prefix)
+        if len(shards) >= count:
+            return shards
+
+        done = sorted(s["shard"] for s in shards)
+        if time.time() - start >= timeout:
+            logger.warning(f"Only shards {done} of {count} finished, not merging")
+            return None
+        logger.info(f"   shards {done} of {count} finished, waiting...")
+        time.sleep(poll_interval)
+
+
+def remove_stale_buildings(client, runs, prefix=""):
+    """
+    Deletes the buildings not loaded by any of the shard runs, that is,
+    removed from the cadastre since the previous load
+    """
+    response = client.delete_by_query(
+        prefix + INDEX_NAME,
+        body={"query": {"bool": {"must_not": [{"terms": {"run": runs}}]}}},
+        conflicts="proceed",
+        refresh=True,
+    )
+    logger.info(f"   removed: {response.get('deleted', 0)}")
+
+
+def merge_shards(
+    client,
+    count,
+    requests_per_second=None,
+    prefix="",
+    bbox=DEFAULT_BBOX,
+    timeout=MERGE_TIMEOUT,
+    task_timeout=TASK_TIMEOUT,
+):
+    """
+    Waits for all the shards to finish, merges their stats and runs
+    the enrichment once
+    """
+    shards = wait_for_shards(client, count, timeout, prefix=prefix)
+    if shards is None:
+        return None
+
+    results = {
+        key: sum(s[key] for s in shards) for key in ["indexed", "skipped", "errors"]
     }
+    logger.info(f"Merged {count} shards:")
+    logger.info(f"   indexed: {results['indexed']}")
+    logger.info(f"   skipped: {results['skipped']}")
+    logger.info(f"   errors:  {results['errors']}")
 
-    count_obj = client.count(body=update_query, index=INDEX_NAME)
-    if "count" in count_obj:
-        count = count_obj["count"]
-        if count > 0:
-            logger.info(f"Reindexing {count} buildings without a footprint id...")
-            client.update_by_query(
-                INDEX_NAME,
-                body=update_query,
-                pipeline="buildings_footprints",
-                wait_for_completion=False
-            )
-            logger.info("Update query sent without waiting for completion")
-        else:
-            logger.info("No buildings to update")
+    runs = [s.get("run") for s in shards]
+    if all(runs):
+        remove_stale_buildings(client, runs, prefix)
+    else:
+        logger.warning("Shards loaded without a run, not removing stale buildings")
+
+    states = prepare_enrichment(client, prefix)
+    if states is None:
+        return None
+
+    save_state(client, LOAD_STATE, {"completed": time.time()}, prefix)
+    finish_enrichment(
+        client, states, True, requests_per_second, prefix, bbox, task_timeout
+    )
+
+    # Ready for the next partitioned run
+    client.indices.delete(index=prefix + SHARDS_INDEX)
+
+    return results
@@ -0,0 +1,150 @@
+"""
+Geometry compaction before geo_shape indexing.
+
+Rounds the coordinates to a fixed number of decimals (7 is ~1 cm),
+removes repeated and collinear vertices and checks the result is still
+valid, falling back to the original geometry otherwise. Saved vertices
+are counted per dataset. The saved bytes need the geometries serialized,
+so they are estimated from a sample unless debug logging is on.
+"""
+import json
+import logging
+import os
+
+import numpy as np
+from shapely.geometry import shape
+
+logger = logging.getLogger("app")
+
+PRECISION = int(os.getenv("GEOMETRY_PRECISION", "7"))
+
+# Geometries serialized to estimate the saved bytes, one in BYTES_SAMPLE
+BYTES_SAMPLE = 100
+
+# Counters per dataset name, region prefix included
+stats = {}
+
+
+def compact_ring(ring, precision):
+    """
+    Returns the rounded closed ring without repeated or collinear
+    points, or None if it collapses
+    """
+    coords = np.round(np.asarray(ring, dtype=np.float64)[:, :2], precision)
+
+    # Repeated consecutive points, including the closing one
+    keep = np.any(coords != np.roll(coords, 1, axis=0), axis=1)
+    coords = coords[keep]
+
+    # Collinear points, the ring is open at this point
+    if len(coords) > 2:
+        prev = np.roll(coords, 1, axis=0)
+        following = np.roll(coords, -1, axis=0)
+        cross = (coords[:, 0] - prev[:, 0]) * (following[:, 1] - coords[:, 1]) - (
+            coords[:, 1] - prev[:, 1]
+        ) * (following[:, 0] - coords[:, 0])
+        coords = coords[cross != 0]
+
+    if len(coords) < 3:
+        return None
+
+    return np.vstack([coords, coords[:1]]).tolist()
+
+
+def compact_polygon(polygon, precision):
+    exterior = compact_ring(polygon[0], precision) if polygon else None
+    if exterior is None:
+        return None
+    holes = [compact_ring(ring, precision) for ring in polygon[1:]]
+    return [exterior] + [hole for hole in holes if hole is not None]
+
+
+def compact_coordinates(geometry, precision):
+    g_type = geometry["type"]
+    if g_type == "Point":
+        coordinates = np.round(geometry["coordinates"], precision).tolist()
+        return {"type": g_type, "coordinates": coordinates}
+    elif g_type == "Polygon":
+        polygon = compact_polygon(geometry["coordinates"], precision)
+        return {"type": g_type, "coordinates": polygon} if polygon else None
+    elif g_type == "MultiPolygon":
+        polygons = [compact_polygon(p, precision) for p in geometry["coordinates"]]
+        polygons = [p for p in polygons if p]
+        return {"type": g_type, "coordinates": polygons} if polygons else None
+    elif g_type == "GeometryCollection":
+        geometries = [compact_coordinates(g, precision) for g in geometry["geometries"]]
+        geometries = [g for g in geometries if g]
+        return {"type": g_type, "geometries": geometries} if geometries else None
+
+    # Other geometry types are not produced by the pipeline
+    return geometry
+
+
+def count_vertices(geometry):
+    g_type = geometry["type"]
+    if g_type == "Point":
+        return 1
+    elif g_type == "Polygon":
+        return sum(len(ring) for ring in geometry["coordinates"])
+    elif g_type == "MultiPolygon":
+        return sum(len(ring) for polygon in geometry["coordinates"] for ring in polygon)
+    elif g_type == "GeometryCollection":
+        return sum(count_vertices(g) for g in geometry["geometries"])
+    return 0
+
+
+def compact(geometry, name="geometries", precision=PRECISION):
+    """
+    Returns the compacted GeoJSON geometry, or the original one if the
+    compacted version is empty or invalid
+    """
+    counters = stats.setdefault(
+        name,
+        {
+            "geometries": 0,
+            "fallbacks": 0,
+            "vertices_before": 0,
+            "vertices_after": 0,
+            "sampled": 0,
+            "bytes_before": 0,
+            "bytes_after": 0,
+        },
+    )
+
+    result = compact_coordinates(geometry, precision)
+    if result is None or (result["type"] != "Point" and not shape(result).is_valid):
+        counters["fallbacks"] += 1
+        result = geometry
+
+    counters["geometries"] += 1
+    counters["vertices_before"] += count_vertices(geometry)
+    counters["vertices_after"] += count_vertices(result)
+    if counters["geometries"] % BYTES_SAMPLE == 1 or logger.isEnabledFor(logging.DEBUG):
+        counters["sampled"] += 1
+        counters["bytes_before"] += len(json.dumps(geometry))
+        counters["bytes_after"] += len(json.dumps(result))
+
+    return result
+
+
+def log_stats(name):
+    counters = stats.get(name)
+    if not counters or counters["geometries"] == 0:
+        return
+
+    saved_vertices = counters["vertices_before"] - counters["vertices_after"]
+
+    logger.info(f"Compacted {counters['geometries']} {name}:")
+    logger.info(f"   vertices saved: {saved_vertices}")
+    if counters["bytes_before"]:
+        saved_bytes = counters["bytes_before"] - counters["bytes_after"]
+        ratio = saved_bytes / counters["bytes_before"] * 100
+        if counters["sampled"] == counters["geometries"]:
+            logger.info(f"   bytes saved:    {saved_bytes} ({ratio:.1f}%)")
+        else:
+            estimate = int(saved_bytes * counters["geometries"] / counters["sampled"])
+            logger.info(
+                f"   bytes saved:    ~{estimate} ({ratio:.1f}%,"
+                f" from {counters['sampled']} geometries)"
+            )
+    logger.info(f"   fallbacks:      {counters['fallbacks']}")
@@ -0,0 +1,71 @@
+"""
+Regions configuration.
+
+Every region (or eruption) declares its sources, its area as a
+[min_lon, min_lat, max_lon, max_lat] bounding box, the time range of the
+earthquakes query and the prefix of its indices. A missing source skips
+that stage for the region.
+"""
+import json
+import os
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "regions.json")
+SOURCES = ["pits", "footprints", "earthquakes", "buildings"]
+
+
+def load_regions(path=None, names=None):
+    """
+    Returns the regions from the configuration file, by default the one
+    set with REGIONS_CONFIG, optionally filtered by name
+    """
+    path = path or os.getenv("REGIONS_CONFIG", CONFIG_PATH)
+    with open(path) as reader:
+        regions = json.load(reader)["regions"]
+
+    for region in regions:
+        if "name" not in region or "bbox" not in region:
+            raise Exception(f"Region without name or bbox in {path}: {region}")
+        region.setdefault("index_prefix", "")
+        region.setdefault("eruption_bbox", region["bbox"])
+        region.setdefault("start_date", None)
+        region.setdefault("end_date", None)
+        region.setdefault("sources", {})
+
+        unknown = set(region["sources"]) - set(SOURCES)
+        if unknown:
+            raise Exception(f"Unknown sources for region {region['name']}: {unknown}")
+
+    prefixes = [r["index_prefix"] for r in regions]
+    if len(set(prefixes)) != len(prefixes):
+        raise Exception("Regions must have different index prefixes")
+
+    if names:
+        regions = [r for r in regions if r["name"] in names]
+
+    return regions
+
+
+def get_footprint_ids(region):
+    """
+    Returns the footprints list of a region, given inline or
+    as the name of a list in the data module
+    """
+    ids = region["sources"].get("footprints")
+    if isinstance(ids, str):
+        import data
+
+        return getattr(data, ids)
+    return ids
+
+
+def to_bounds(bbox):
+    min_lon, min_lat, max_lon, max_lat = bbox
+    return {"min_lon": min_lon, "min_lat": min_lat, "max_lon": max_lon, "max_lat": max_lat}
+
+
+def to_bounding_box(bbox):
+    min_lon, min_lat, max_lon, max_lat = bbox
+    return {
+        "top_left": {"lat": max_lat, "lon": min_lon},
+        "bottom_right": {"lat": min_lat, "lon": max_lon},
+    }
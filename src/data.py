@@ -1,7 +1,14 @@
+import os
+import threading
+
 from pytz import timezone
-import requests_cache
 
-session = requests_cache.CachedSession("http_cache", use_cache_dir=True)
+# Shared HTTP session, created on first use
+session = None
+session_lock = threading.Lock()
+
+# Local state (task ids, fingerprints, ...) lives next to the HTTP cache
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache")
 
 LOC_CANARY = timezone("Atlantic/Canary")
 
@@ -86,7 +93,7 @@ def download_geojson(geojson_url):
     """
     Get the buildings data for La Palma
     """
-    r = session.get(geojson_url)
+    r = get_session().get(geojson_url)
     if r.status_code != 200:
         raise Exception("Error downloading the buildings GeoJSON")
 
@@ -96,3 +103,25 @@ def download_geojson(geojson_url):
         raise Exception(f"Returned JSON is not a valid GeoJSON: [{r_obj.keys()}]")
 
     return r_obj["features"]
+
+
+def get_session():
+    """
+    Returns the HTTP session shared by all the stages, cached in SQLite
+    """
+    global session
+    with session_lock:
+        if session is None:
+            # Imported here to keep the app startup fast
+            import requests_cache
+
+            session = requests_cache.CachedSession("http_cache", use_cache_dir=True)
+    return session
+
+
+def get_cache_path(file_name):
+    """
+    Returns the path of a state file stored in the user cache directory
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    return os.path.join(CACHE_DIR, file_name)
@@ -4,22 +4,23 @@ import logging
 import warnings
 from datetime import datetime
 
-import requests_cache
-from elasticsearch.helpers import bulk
 from elasticsearch.exceptions import NotFoundError
 
-from data import LOC_CANARY
+import journal
+from data import LOC_CANARY, get_session
 
 INDEX_NAME = "earthquakes"
+# Checkpoint journal name for the quakes load
+JOURNAL_STAGE = "earthquakes"
+# Default area [min_lon, min_lat, max_lon, max_lat] and start of the catalog query
+BBOX = [-18.045731, 28.436695, -17.685928, 28.868729]
+START_DATE = "2021-08-01"
 
 warnings.filterwarnings("ignore")
 logging.getLogger("elasticsearch").setLevel(logging.ERROR)
 
-logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger("app")
 
-session = requests_cache.CachedSession("http_cache", use_cache_dir=True)
-
 
 def get_quake(row):
     parts = list(map(lambda x: x.strip(), row.split(";")))
@@ -52,10 +53,13 @@ def get_quake(row):
         return None
 
 
-def download_earthquakes():
+def download_earthquakes(bbox=BBOX, start_date=START_DATE, end_date=None):
     """
     Downloads the Earthquakes data from the Spanish National Mapping Agency
     """
+    start = datetime.strptime(start_date, "%Y-%m-%d")
+    end = datetime.strptime(end_date, "%Y-%m-%d") if end_date else datetime.now()
+
     EARTHQUAKE_URL = "https://www.ign.es/web/ign/portal/sis-catalogo-terremotos?"
     EARTHQUAKE_URL_PARAMS = {
         "p_p_id": "IGNSISCatalogoTerremotos_WAR_IGNSISCatalogoTerremotosportlet",
@@ -76,12 +80,12 @@ def download_earthquakes():
         "selIntensidad": "N",
         "selMagnitud": "N",
         "selProf": "N",
-        "latMin": "28.436695",
-        "latMax": "28.868729",
-        "longMin": "-18.045731",
-        "longMax": "-17.685928",
-        "startDate": "01/08/2021",
-        "endDate": datetime.strftime(datetime.now(), "%d/%m/%Y"),
+        "latMin": str(bbox[1]),
+        "latMax": str(bbox[3]),
+        "longMin": str(bbox[0]),
+        "longMax": str(bbox[2]),
+        "startDate": datetime.strftime(start, "%d/%m/%Y"),
+        "endDate": datetime.strftime(end, "%d/%m/%Y"),
         "intMin": "",
         "intMax": "",
         "magMin": "",
@@ -104,7 +108,7 @@ def download_earthquakes():
         + "------WebKitFormBoundaryl7CMY2CM99CkEfej--\r\n"
     )
 
-    r = session.post(EARTHQUAKE_URL, params=EARTHQUAKE_URL_PARAMS, data=form_data)
+    r = get_session().post(EARTHQUAKE_URL, params=EARTHQUAKE_URL_PARAMS, data=form_data)
 
     if r.status_code != 200:
         logger.error("Wrong request!")
@@ -119,23 +123,34 @@ def download_earthquakes():
     return list(filtered_quakes)
 
 
-def index_quakes(client, quakes):
+def index_quakes(client, quakes, prefix=""):
     """
     Recreates the index for the Earthquakes and uploads the data
     """
+    index_name = prefix + INDEX_NAME
+    journal_stage = prefix + JOURNAL_STAGE
+
     # Create the index if absent
     try:
         # Only repopulate if the number of quakes is higher than the index doc count
-        count_obj = client.count(index=INDEX_NAME)
+        count_obj = client.count(index=index_name)
         if "count" in count_obj and count_obj["count"] == len(quakes):
             logger.info('Index has the same number of documents than downloaded data, skipping')
+            journal.complete(journal_stage)
             return
 
-        client.indices.delete(index=INDEX_NAME)
+        # Fill in a partially loaded index
+        if journal.is_pending(journal_stage):
+            logger.info("Resuming the previous quakes load")
+            upload_quakes(client, quakes, prefix)
+            return
+
+        client.indices.delete(index=index_name)
     except NotFoundError:
         logger.debug("Index not found, nothing to delete")
+        journal.complete(journal_stage)
     client.indices.create(
-        index=INDEX_NAME,
+        index=index_name,
         settings={"number_of_shards": 1, "number_of_replicas": 1},
         mappings={
             "properties": {
@@ -156,16 +171,14 @@ def index_quakes(client, quakes):
         },
     )
 
-    # Only repopulate if the number of quakes is higher than the index doc count
-    count_obj = client.count(index=INDEX_NAME)
-    if "count" in count_obj and count_obj["count"] == len(quakes):
-        logger.info('Index has the same number of documents than downloaded data, skipping')
-        return
+    upload_quakes(client, quakes, prefix)
+
 
+def upload_quakes(client, quakes, prefix=""):
     actions = list(
         map(
             lambda quake: {
-                "_index": "earthquakes",
+                "_index": prefix + INDEX_NAME,
                 "_op_type": "index",
                 "_id": quake["id"],
                 "_source": quake,
@@ -175,7 +188,10 @@ def index_quakes(client, quakes):
     )
 
     logger.info(f"Uploading to ES {len(actions)} records...")
-    bulk(client, actions)
+    results = journal.bulk(client, prefix + JOURNAL_STAGE, actions)
+    logger.info(f"   indexed: {results['indexed']}")
+    logger.info(f"   skipped: {results['skipped']}")
+    logger.info(f"   errors:  {results['errors']}")
 
 
 def get_geojson_feature(feature):
@@ -189,12 +205,12 @@ def get_geojson_feature(feature):
     return {"type": "Feature", "geometry": geometry, "properties": properties}
 
 
-def export(features):
+def export(features, prefix=""):
     """
     Creates a GeoJSON for the earthquakes
     """
 
-    FILE_PATH = "/tmp/earthquakes.geo.json"
+    FILE_PATH = f"/tmp/{prefix}earthquakes.geo.json"
 
     with open(FILE_PATH, "w") as writer:
         f_features = map(get_geojson_feature, features)
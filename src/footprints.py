@@ -4,42 +4,40 @@ import warnings
 from datetime import datetime
 from copy import deepcopy
 
-import requests_cache
-
 from elasticsearch import NotFoundError
 from elasticsearch.exceptions import RequestError
+from elasticsearch.helpers import bulk
 
 from geojson_rewind import rewind
-from area import area
+from geoarea import areas
+from compaction import compact
 from shapely.geometry import shape, mapping
 from shapely.geometry.multipolygon import MultiPolygon
-from shapely.validation import make_valid
+from repair import repair_all
 
 # from shapely.validation import make_valid
 
-from data import IDS, LOC_CANARY
+from data import IDS, LOC_CANARY, get_session
 
 warnings.filterwarnings("ignore")
 logging.getLogger("elasticsearch").setLevel(logging.ERROR)
 
-logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger("app")
 
-session = requests_cache.CachedSession("http_cache", use_cache_dir=True)
-
 INDEX_NAME = "lapalma"
 GEOJSON_URL = "https://opendata.arcgis.com/api/v3/datasets/{id}/downloads/data?"
 GEOJSON_PARAMS = {"format": "geojson", "spatialRefId": "4326"}
+GROWTH_INDEX_NAME = "lapalma_growth"
 
 
-def create_footprints_index(client):
+def create_footprints_index(client, prefix=""):
     """
     Creates the index to host the footprints data
     """
     # Create the index if absent
-    if not client.indices.exists(index=INDEX_NAME):
+    if not client.indices.exists(index=prefix + INDEX_NAME):
         client.indices.create(
-            index=INDEX_NAME,
+            index=prefix + INDEX_NAME,
             settings={"number_of_shards": 1, "number_of_replicas": 1},
             mappings={
                 "properties": {
@@ -56,7 +54,7 @@ def create_footprints_index(client):
         )
 
 
-def download_footprints():
+def download_footprints(ids=IDS, prefix=""):
     """
     Downloads the footprints from La Palma data portal and returns
     a list of dictionaries with the geometries with their identifier,
@@ -67,21 +65,22 @@ def download_footprints():
     features = []
 
     # Get the IDs into the features and sort them
-    for id_date in IDS:
+    for id_date in ids:
         id = id_date[0]
 
         # Download the GeoJSON and store the fixed geometry
         logger.debug(f"Getting the resource [{id}] ...")
         url = GEOJSON_URL.format(id=id)
-        r = session.get(url, params=GEOJSON_PARAMS)
+        r = get_session().get(url, params=GEOJSON_PARAMS)
 
         if r.status_code != 200:
             logger.error(f"Resource [{id}] not found at {url}")
         else:
             json_dataset = r.json()
             if "features" in json_dataset and "geometry" in json_dataset["features"][0]:
-                geometry = rewind(json_dataset["features"][0]["geometry"])
-                geom_area = int(area(geometry))
+                geometry = compact(
+                    rewind(json_dataset["features"][0]["geometry"]), prefix + "footprints"
+                )
                 timestamp = datetime.strptime(
                     f"{id_date[1]} {id_date[2]}", "%Y-%m-%d %H:%M"
                 )
@@ -91,33 +90,41 @@ def download_footprints():
                         "id": id,
                         "geometry": geometry,
                         "timestamp": LOC_CANARY.localize(timestamp).isoformat(),
-                        "area": geom_area,
                     }
                 )
+
+    # Compute all the areas in a single call
+    for feature, geom_area in zip(features, areas(f["geometry"] for f in features)):
+        feature["area"] = int(geom_area)
+
     return features
 
 
-def filter_area(polygon):
+def filter_area(polygons):
+    """
+    Returns the polygons larger than the tolerance, in square meters
+    """
     TOLERANCE = 1
-    return area(mapping(polygon)) > TOLERANCE
+    polygons = list(polygons)
+    polygon_areas = areas(mapping(polygon) for polygon in polygons)
+    return [p for p, p_area in zip(polygons, polygon_areas) if p_area > TOLERANCE]
 
 
-def get_diffed_features(features):
+def get_diffed_features(features, prefix=""):
     """
     Extends the footprints with the difference with the previous footprint
     """
     TOLERANCE = 0.000001
     sorted_features = sorted(features, key=lambda f: f["timestamp"])
-    diffed_features = []
+    diff_geoms = []
 
     for idx, f in enumerate(sorted_features):
-        curr_feature = deepcopy(f)
         prev_feature = sorted_features[idx - 1] if idx > 0 else None
 
-        curr_geom = shape(curr_feature["geometry"])
+        curr_geom = shape(f["geometry"])
 
         if prev_feature is None:
-            logger.debug(f"{curr_feature['id']} has no previous feature")
+            logger.debug(f"{f['id']} has no previous feature")
             diff_geom = curr_geom
         else:
             diff_geom = curr_geom.difference(shape(prev_feature["geometry"])).simplify(
@@ -126,42 +133,51 @@ def get_diffed_features(features):
             if diff_geom.geom_type == 'MultiPolygon':
                 # Remove small polygons
                 parts = len(diff_geom.geoms)
-                diff_geom = MultiPolygon([poly for poly in diff_geom.geoms if filter_area(poly)])
+                diff_geom = MultiPolygon(filter_area(diff_geom.geoms))
                 parts_after = len(diff_geom.geoms)
                 if parts != parts_after:
                     logger.debug(f"{parts - parts_after} small parts removed")
 
-        # Try to fix any invalid geometries
-        if not diff_geom.is_valid:
-            diff_geom = make_valid(diff_geom)
-        if not diff_geom.is_valid:
-            logger.debug("Trying to fix the geometry with the buffer trick")
-            diff_geom = diff_geom.buffer(0.0)
+        diff_geoms.append(diff_geom)
+
+    # Fix any invalid geometries in a single batch
+    diff_geoms = repair_all(
+        diff_geoms, prefix + "diffs", (f["id"] for f in sorted_features)
+    )
 
-        if diff_geom.is_valid:
-            diff_geom_geojson = mapping(diff_geom)
+    diffed_features = []
+    for idx, diff_geom in enumerate(diff_geoms):
+        curr_feature = deepcopy(sorted_features[idx])
+        prev_feature = sorted_features[idx - 1] if idx > 0 else None
+
+        if diff_geom is not None:
+            diff_geom_geojson = compact(mapping(diff_geom), prefix + "diffs")
 
             # Create the new properties
             diff_feature = {
                 "diff_id": prev_feature["id"] if prev_feature else None,
                 "diff_timestamp": prev_feature["timestamp"] if prev_feature else None,
                 "diff_geometry": diff_geom_geojson,
-                "diff_area": int(area(diff_geom_geojson)),
             }
             diff_feature.update(curr_feature)
 
             diffed_features.append(diff_feature)
         else:
-            logger.warning(f"SKIPPING [{id}], check the geometry")
+            logger.warning(f"SKIPPING [{curr_feature['id']}], check the geometry")
+
+    # Compute all the diff areas in a single call
+    diff_areas = areas(f["diff_geometry"] for f in diffed_features)
+    for feature, diff_area in zip(diffed_features, diff_areas):
+        feature["diff_area"] = int(diff_area)
 
     return diffed_features
 
 
-def upload_footrpint(client, doc):
+def upload_footrpint(client, doc, prefix=""):
     id = doc["id"]
     try:
         logger.debug(f"[{id}] uploading to ES...")
-        client.index(index=INDEX_NAME, id=id, document=doc)
+        client.index(index=prefix + INDEX_NAME, id=id, document=doc)
         return True
     except RequestError as e:
         logger.error(f"Error uploading [{id}] with: {e.error}")
@@ -169,7 +185,7 @@ def upload_footrpint(client, doc):
         return False
 
 
-def index_footprints(client, features, overwrite=False):
+def index_footprints(client, features, overwrite=False, prefix=""):
     """
     Uploads to Elasticsearch the features not found in the index
     """
@@ -179,14 +195,14 @@ def index_footprints(client, features, overwrite=False):
         upload = overwrite
         if not overwrite:
             try:
-                client.get(index=INDEX_NAME, id=id)
+                client.get(index=prefix + INDEX_NAME, id=id)
                 logger.debug(f"[{id}] found in ES...")
                 upload = False
             except NotFoundError:
                 upload = True
 
         if upload:
-            uploaded = upload_footrpint(client, doc)
+            uploaded = upload_footrpint(client, doc, prefix)
             if uploaded:
                 results["indexed"] = results["indexed"] + 1
             else:
@@ -196,6 +212,104 @@ def index_footprints(client, features, overwrite=False):
     return results
 
 
+def create_growth_index(client, prefix=""):
+    """
+    Creates the index to host the lava growth time series
+    """
+    if not client.indices.exists(index=prefix + GROWTH_INDEX_NAME):
+        client.indices.create(
+            index=prefix + GROWTH_INDEX_NAME,
+            settings={"number_of_shards": 1, "number_of_replicas": 1},
+            mappings={
+                "properties": {
+                    "id": {"type": "keyword"},
+                    "timestamp": {"type": "date"},
+                    "area": {"type": "long"},
+                    "new_area": {"type": "long"},
+                    "cumulative_new_area": {"type": "long"},
+                    "hours": {"type": "float"},
+                    "rate": {"type": "float"},
+                    "parts": {"type": "integer"},
+                }
+            },
+        )
+
+
+def count_parts(geometry):
+    if geometry["type"] == "MultiPolygon":
+        return len(geometry["coordinates"])
+    elif geometry["type"] == "GeometryCollection":
+        return sum(count_parts(g) for g in geometry["geometries"])
+    return 1 if geometry["type"] == "Polygon" and geometry["coordinates"] else 0
+
+
+def get_growth_series(diffed_features):
+    """
+    Returns the lava growth between consecutive footprints: covered
+    area, new area, rate per hour between surveys and new parts
+    """
+    series = []
+    cumulative = 0
+    prev_time = None
+
+    for f in sorted(diffed_features, key=lambda f: f["timestamp"]):
+        curr_time = datetime.fromisoformat(f["timestamp"])
+        hours = (curr_time - prev_time).total_seconds() / 3600 if prev_time else None
+        cumulative += f["diff_area"]
+
+        series.append(
+            {
+                "id": f["id"],
+                "timestamp": f["timestamp"],
+                "area": f["area"],
+                "new_area": f["diff_area"],
+                "cumulative_new_area": cumulative,
+                "hours": hours,
+                "rate": f["diff_area"] / hours if hours else None,
+                "parts": count_parts(f["diff_geometry"]),
+            }
+        )
+        prev_time = curr_time
+
+    return series
+
+
+def index_growth(client, series, prefix=""):
+    """
+    Uploads the growth documents from the first one not found in the
+    index, as the later ones depend on it
+    """
+    create_growth_index(client, prefix)
+
+    if len(series) == 0:
+        return 0
+
+    response = client.mget(
+        index=prefix + GROWTH_INDEX_NAME, body={"ids": [d["id"] for d in series]}
+    )
+    found = [doc.get("found", False) for doc in response["docs"]]
+    if all(found):
+        logger.info("Growth series up to date")
+        return 0
+
+    pending = series[found.index(False):]
+    logger.info(f"Indexing {len(pending)} growth documents...")
+    bulk(
+        client,
+        (
+            {
+                "_index": prefix + GROWTH_INDEX_NAME,
+                "_op_type": "index",
+                "_id": doc["id"],
+                "_source": doc,
+            }
+            for doc in pending
+        ),
+    )
+
+    return len(pending)
+
+
 def get_footprint_feature(feature):
     return {
         'type': 'Feature',
@@ -230,12 +344,12 @@ def get_diff_footprint_feature(feature):
     return diff_feature
 
 
-def export(features):
+def export(features, prefix=""):
     """
     Creates a GeoJSON for the footprints and another for the diffs
     """
 
-    FILE_PATH = '/tmp/footprints.geo.json'
+    FILE_PATH = f'/tmp/{prefix}footprints.geo.json'
     with open(FILE_PATH, 'w') as writer:
         f_features = map(get_footprint_feature, features)
         logger.debug(f"Exporting full footprints GeoJSON into {FILE_PATH}")
@@ -244,7 +358,7 @@ def export(features):
             'features': list(f_features)
         }, writer)
 
-    FILE_PATH = '/tmp/footprints_diff.geo.json'
+    FILE_PATH = f'/tmp/{prefix}footprints_diff.geo.json'
     with open(FILE_PATH, 'w') as writer:
         f_features = map(get_diff_footprint_feature, features)
         logger.debug(f"Exporting diff footprints GeoJSON into {FILE_PATH}")
@@ -0,0 +1,119 @@
+"""
+Vectorized geodesic area for GeoJSON polygons.
+
+Implements the same spherical approximation as the `area` package
+(Chamberlain & Duquette) but for many geometries at once with NumPy.
+Results match `area.area` within a relative tolerance of 1e-9 or an
+absolute tolerance of 1e-6 square meters, the differences coming only
+from the summation order (the absolute one covers small polygons with
+holes, where the rings areas cancel out).
+"""
+from itertools import chain
+
+import numpy as np
+
+WGS84_RADIUS = 6378137
+# Relative and absolute (square meters) tolerances against the pure
+# Python `area` package
+TOLERANCE = 1e-9
+ABS_TOLERANCE = 1e-6
+
+
+def get_polygons(geometry):
+    """
+    Returns the list of polygons (list of rings) of a GeoJSON geometry
+    """
+    if geometry is None:
+        return []
+
+    g_type = geometry["type"]
+    if g_type == "Polygon":
+        return [geometry["coordinates"]]
+    elif g_type == "MultiPolygon":
+        return geometry["coordinates"]
+    elif g_type == "GeometryCollection":
+        return [p for g in geometry["geometries"] for p in get_polygons(g)]
+
+    return []
+
+
+def get_rings(geometries):
+    """
+    Flattens the geometries into a single coordinates array and
+    returns it with the length, sign and geometry index of every ring
+    """
+    rings = []
+    lengths = []
+    signs = []
+    owners = []
+
+    for g_idx, geometry in enumerate(geometries):
+        for polygon in get_polygons(geometry):
+            for r_idx, ring in enumerate(polygon):
+                rings.append(ring)
+                lengths.append(len(ring))
+                # Exterior rings add area, holes subtract it
+                signs.append(1.0 if r_idx == 0 else -1.0)
+                owners.append(g_idx)
+
+    points = sum(lengths)
+    values = chain.from_iterable(chain.from_iterable(rings))
+    coords = np.fromiter(values, dtype=np.float64)
+    if len(coords) != 2 * points:
+        # Drop any third dimension
+        coords = np.asarray([c[:2] for ring in rings for c in ring], dtype=np.float64)
+    coords = coords.reshape(points, 2)
+
+    return (
+        coords,
+        np.asarray(lengths, dtype=np.int64),
+        np.asarray(signs, dtype=np.float64),
+        np.asarray(owners, dtype=np.int64),
+    )
+
+
+def rings_area(coords, lengths):
+    """
+    Returns the signed area of every ring of a flattened coordinates array
+    """
+    if len(lengths) == 0:
+        return np.zeros(0)
+
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    ring_ids = np.repeat(np.arange(len(lengths)), lengths)
+    ring_starts = np.repeat(starts, lengths)
+    ring_lengths = np.repeat(lengths, lengths)
+    local = np.arange(len(coords)) - ring_starts
+
+    # Same vertex triplets as `area.ring__area`, wrapping around the ring
+    middle = ring_starts + (local + 1) % ring_lengths
+    upper = ring_starts + (local + 2) % ring_lengths
+
+    lon = np.radians(coords[:, 0])
+    lat = np.radians(coords[:, 1])
+    terms = (lon[upper] - lon) * np.sin(lat[middle])
+
+    result = np.bincount(ring_ids, weights=terms, minlength=len(lengths))
+    # Rings with less than three points have no area
+    result[lengths <= 2] = 0
+
+    return result * WGS84_RADIUS * WGS84_RADIUS / 2
+
+
+def areas(geometries):
+    """
+    Returns a NumPy array with the geodesic area in square meters
+    of every GeoJSON geometry
+    """
+    geometries = list(geometries)
+    coords, lengths, signs, owners = get_rings(geometries)
+    ring_areas = np.abs(rings_area(coords, lengths)) * signs
+
+    return np.bincount(owners, weights=ring_areas, minlength=len(geometries))
+
+
+def area(geometry):
+    """
+    Geodesic area of a single GeoJSON geometry
+    """
+    return float(areas([geometry])[0])
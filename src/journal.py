@@ -0,0 +1,141 @@
+"""
+Checkpoint journal for resumable ingestion.
+
+Every stage run appends the ids acknowledged by Elasticsearch, chunk by
+chunk, to a JSON lines file in the user cache directory. If the run is
+interrupted or some documents were rejected, the next one finds the
+pending journal, skips the acknowledged documents and fills in the
+partially loaded index. The journal is removed when the run completes
+without errors.
+"""
+import json
+import logging
+import os
+from datetime import datetime
+
+from elasticsearch.helpers import streaming_bulk
+
+from data import get_cache_path
+
+logger = logging.getLogger("app")
+
+CHUNK_SIZE = 500
+
+
+def get_path(stage):
+    return get_cache_path(f"journal_{stage}.jsonl")
+
+
+def load(stage):
+    """
+    Returns the run id and the acknowledged ids of a pending run, or None
+    """
+    path = get_path(stage)
+    try:
+        with open(path) as reader:
+            raw_lines = reader.readlines()
+    except OSError:
+        return None
+
+    lines = []
+    for idx, line in enumerate(raw_lines):
+        if not line.strip():
+            continue
+        try:
+            lines.append(json.loads(line))
+        except ValueError:
+            if idx < len(raw_lines) - 1:
+                logger.warning(f"Corrupted {stage} journal, starting over")
+                return None
+            # A run killed while appending leaves a truncated last line,
+            # removed so the next checkpoints start on a new line
+            logger.warning(f"Dropping the truncated last line of the {stage} journal")
+            with open(path, "w") as writer:
+                writer.writelines(raw_lines[:idx])
+
+    if len(lines) == 0 or "run" not in lines[0]:
+        return None
+
+    ids = set()
+    for line in lines[1:]:
+        ids.update(line.get("ids", []))
+
+    return {"run": lines[0]["run"], "ids": ids}
+
+
+def is_pending(stage):
+    return load(stage) is not None
+
+
+def new_run_id():
+    return datetime.now().isoformat()
+
+
+def start(stage, run_id=None):
+    """
+    Starts a new run journal, discarding any previous one
+    """
+    run = run_id or new_run_id()
+    with open(get_path(stage), "w") as writer:
+        writer.write(json.dumps({"run": run}) + "\n")
+    return {"run": run, "ids": set()}
+
+
+def append(stage, ids):
+    with open(get_path(stage), "a") as writer:
+        writer.write(json.dumps({"ids": ids}) + "\n")
+
+
+def complete(stage):
+    try:
+        os.remove(get_path(stage))
+    except OSError:
+        pass
+
+
+def bulk(client, stage, actions, chunk_size=CHUNK_SIZE, run_id=None):
+    """
+    Bulk loads the actions not acknowledged in a pending run, writing
+    a checkpoint after every chunk, or starts a new run with the given
+    id. Returns the indexed, skipped and error counts.
+    """
+    run = load(stage)
+    if run is None:
+        run = start(stage, run_id)
+    else:
+        logger.info(f"Resuming run {run['run']} with {len(run['ids'])} acknowledged documents")
+
+    results = {"indexed": 0, "skipped": 0, "errors": 0}
+
+    def pending_actions():
+        for action in actions:
+            if action["_id"] in run["ids"]:
+                results["skipped"] += 1
+            else:
+                yield action
+
+    acked = []
+    for ok, item in streaming_bulk(
+        client, pending_actions(), chunk_size=chunk_size, raise_on_error=False
+    ):
+        op = next(iter(item.values()))
+        if ok:
+            acked.append(op["_id"])
+            results["indexed"] += 1
+        else:
+            logger.error(f"[{op.get('_id')}] - {op.get('error')}")
+            results["errors"] += 1
+
+        if len(acked) >= chunk_size:
+            append(stage, acked)
+            acked = []
+
+    if acked:
+        append(stage, acked)
+
+    # Rejected documents are retried by the next run
+    if results["errors"] > 0:
+        logger.warning(f"{results['errors']} documents rejected, keeping the {stage} journal")
+    else:
+        complete(stage)
+    return results
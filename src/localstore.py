@@ -0,0 +1,852 @@
+"""
+Local spatial store backend.
+
+An Elasticsearch transport that serves the requests of the pipeline
+from an embedded SQLite database instead of a cluster, so every stage
+runs unchanged with `get_client(path)` as its client. Documents are
+stored as JSON and the bounding boxes of their geo_shape and geo_point
+fields go into an R-tree index, used to prefilter the bounding box and
+shape queries and the enrich geo_match lookups.
+
+Only the APIs the pipeline uses are implemented: indices (create,
+exists, delete, alias, mapping), documents (index, get, mget, bulk),
+search and count with a subset of the query DSL, delete by query,
+update by query with the enrich and remove processors, enrich
+policies, ingest pipelines and tasks.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from urllib.parse import unquote
+
+from elasticsearch.exceptions import NotFoundError, RequestError
+from elasticsearch.serializer import JSONSerializer
+from shapely.geometry import box, shape
+from shapely.prepared import prep
+
+logger = logging.getLogger("app")
+
+GEO_TYPES = ("geo_shape", "geo_point")
+ENRICH_PREFIX = ".enrich-"
+TASK_NODE = "local"
+
+
+def get_client(path):
+    """
+    Returns an Elasticsearch client backed by the local store at path
+    """
+    from elasticsearch import Elasticsearch
+
+    return Elasticsearch(transport_class=LocalTransport, path=path)
+
+
+def get_param(params, name, default=None):
+    value = (params or {}).get(name, default)
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    return value
+
+
+def get_field(source, field):
+    """
+    Returns the value of a dotted field or None
+    """
+    value = source
+    for key in field.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def remove_field(source, field):
+    *path, last = field.split(".")
+    parent = get_field(source, ".".join(path)) if path else source
+    if isinstance(parent, dict) and last in parent:
+        del parent[last]
+        return True
+    return False
+
+
+def filter_source(source, includes):
+    if includes is None or includes is True:
+        return source
+    if includes is False:
+        return None
+    if isinstance(includes, str):
+        includes = includes.split(",")
+    result = {}
+    for field in includes:
+        value = get_field(source, field)
+        if value is not None:
+            result[field] = value
+    return result
+
+
+def get_geometry(value):
+    """
+    Returns a shapely geometry from a GeoJSON geometry or a geo_point
+    given as [lon, lat], {"lat", "lon"} or "lat,lon"
+    """
+    if value is None:
+        return None
+    if isinstance(value, dict) and "type" in value:
+        return shape(value)
+    if isinstance(value, dict):
+        return shape({"type": "Point", "coordinates": [value["lon"], value["lat"]]})
+    if isinstance(value, str):
+        lat, lon = [float(v) for v in value.split(",")]
+        return shape({"type": "Point", "coordinates": [lon, lat]})
+    return shape({"type": "Point", "coordinates": list(value)[:2]})
+
+
+def get_box(query):
+    """
+    Returns the shapely box of a geo_bounding_box field condition
+    """
+    top_left, bottom_right = query["top_left"], query["bottom_right"]
+    return box(top_left["lon"], bottom_right["lat"], bottom_right["lon"], top_left["lat"])
+
+
+def get_geo_filter(query):
+    """
+    Returns the field and shapely geometry of a top level or filter/must
+    spatial condition, to prefilter the candidates with the R-tree
+    """
+    if "geo_bounding_box" in query:
+        field, condition = next(iter(query["geo_bounding_box"].items()))
+        return field, get_box(condition)
+    if "geo_shape" in query:
+        field, condition = next(iter(query["geo_shape"].items()))
+        if condition.get("relation", "intersects").lower() == "intersects":
+            return field, shape(condition["shape"])
+    if "bool" in query:
+        for occur in ("filter", "must"):
+            clauses = query["bool"].get(occur, [])
+            for clause in clauses if isinstance(clauses, list) else [clauses]:
+                geo_filter = get_geo_filter(clause)
+                if geo_filter is not None:
+                    return geo_filter
+    return None
+
+
+def match_ids(condition, doc_id, source):
+    return doc_id in condition["values"]
+
+
+def match_term(condition, doc_id, source):
+    field, value = next(iter(condition.items()))
+    if isinstance(value, dict):
+        value = value["value"]
+    actual = get_field(source, field)
+    if isinstance(actual, list):
+        return value in actual
+    return actual == value
+
+
+def match_terms(condition, doc_id, source):
+    field, values = next(iter(condition.items()))
+    return get_field(source, field) in values
+
+
+def match_exists(condition, doc_id, source):
+    return get_field(source, condition["field"]) not in (None, [])
+
+
+def match_geo_bounding_box(condition, doc_id, source):
+    field, bounds = next(iter(condition.items()))
+    geometry = get_geometry(get_field(source, field))
+    return geometry is not None and get_box(bounds).intersects(geometry)
+
+
+def match_geo_shape(condition, doc_id, source):
+    field, options = next(iter(condition.items()))
+    geometry = get_geometry(get_field(source, field))
+    if geometry is None:
+        return False
+    other = shape(options["shape"])
+    relation = options.get("relation", "intersects").lower()
+    if relation == "within":
+        return geometry.within(other)
+    if relation == "contains":
+        return geometry.contains(other)
+    if relation == "disjoint":
+        return geometry.disjoint(other)
+    return geometry.intersects(other)
+
+
+def match_bool(condition, doc_id, source):
+    clauses = {}
+    for occur in ("must", "filter", "should", "must_not"):
+        value = condition.get(occur, [])
+        clauses[occur] = value if isinstance(value, list) else [value]
+
+    if not all(matches(q, doc_id, source) for q in clauses["must"] + clauses["filter"]):
+        return False
+    if any(matches(q, doc_id, source) for q in clauses["must_not"]):
+        return False
+    if clauses["should"]:
+        return any(matches(q, doc_id, source) for q in clauses["should"])
+    return True
+
+
+# Supported query clauses
+MATCHERS = {
+    "match_all": lambda condition, doc_id, source: True,
+    "ids": match_ids,
+    "term": match_term,
+    "terms": match_terms,
+    "exists": match_exists,
+    "geo_bounding_box": match_geo_bounding_box,
+    "geo_shape": match_geo_shape,
+    "bool": match_bool,
+}
+
+
+def matches(query, doc_id, source):
+    """
+    Evaluates the supported query DSL subset on a document
+    """
+    if not query:
+        return True
+
+    for clause, condition in query.items():
+        if clause in MATCHERS:
+            return MATCHERS[clause](condition, doc_id, source)
+
+    raise RequestError(400, "parsing_exception", f"Unsupported query: {list(query)}")
+
+
+class LocalTransport:
+    """
+    Elasticsearch transport backed by SQLite with an R-tree index
+    """
+
+    def __init__(self, hosts=None, path="lapalma.sqlite", **kwargs):
+        self.hosts = hosts
+        self.path = path
+        self.serializer = JSONSerializer()
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS indices (
+                name TEXT PRIMARY KEY, mappings TEXT, aliases TEXT
+            );
+            CREATE TABLE IF NOT EXISTS docs (
+                key INTEGER PRIMARY KEY, idx TEXT, id TEXT, source TEXT,
+                UNIQUE (idx, id)
+            );
+            CREATE TABLE IF NOT EXISTS geo_keys (
+                key INTEGER PRIMARY KEY, doc INTEGER, field TEXT
+            );
+            CREATE INDEX IF NOT EXISTS geo_keys_doc ON geo_keys (doc);
+            CREATE VIRTUAL TABLE IF NOT EXISTS geo_index USING rtree (
+                key, min_x, max_x, min_y, max_y
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                kind TEXT, name TEXT, value TEXT, PRIMARY KEY (kind, name)
+            );
+            """)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    # Metadata: enrich policies, ingest pipelines and tasks
+
+    def get_meta(self, kind, name):
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE kind = ? AND name = ?", (kind, name)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_meta(self, kind, name, value):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO meta VALUES (?, ?, ?)",
+            (kind, name, json.dumps(value)),
+        )
+
+    # Indices
+
+    def resolve(self, name):
+        """
+        Returns the index name of an index or alias, or None
+        """
+        row = self.connection.execute(
+            "SELECT name FROM indices WHERE name = ?", (name,)
+        ).fetchone()
+        if row:
+            return row[0]
+        for index_name, aliases in self.connection.execute(
+            "SELECT name, aliases FROM indices"
+        ):
+            if name in json.loads(aliases):
+                return index_name
+        return None
+
+    def get_index(self, name, create=False):
+        index_name = self.resolve(name)
+        if index_name is None:
+            if not create:
+                raise NotFoundError(
+                    404, "index_not_found_exception", {"error": f"no such index [{name}]"}
+                )
+            self.create_index(name, {})
+            index_name = name
+        return index_name
+
+    def create_index(self, name, body):
+        if self.resolve(name) is not None:
+            raise RequestError(
+                400,
+                "resource_already_exists_exception",
+                {"error": f"index [{name}] already exists"},
+            )
+        self.connection.execute(
+            "INSERT INTO indices VALUES (?, ?, ?)",
+            (
+                name,
+                json.dumps((body or {}).get("mappings", {})),
+                json.dumps(list((body or {}).get("aliases", {}))),
+            ),
+        )
+        return {"acknowledged": True, "shards_acknowledged": True, "index": name}
+
+    def delete_index(self, name):
+        index_name = self.get_index(name)
+        self.connection.execute(
+            "DELETE FROM geo_index WHERE key IN (SELECT geo_keys.key FROM geo_keys"
+            " JOIN docs ON docs.key = geo_keys.doc WHERE docs.idx = ?)",
+            (index_name,),
+        )
+        self.connection.execute(
+            "DELETE FROM geo_keys WHERE doc IN (SELECT key FROM docs WHERE idx = ?)",
+            (index_name,),
+        )
+        self.connection.execute("DELETE FROM docs WHERE idx = ?", (index_name,))
+        self.connection.execute("DELETE FROM indices WHERE name = ?", (index_name,))
+        return {"acknowledged": True}
+
+    def put_alias(self, name, alias):
+        index_name = self.get_index(name)
+        aliases = json.loads(
+            self.connection.execute(
+                "SELECT aliases FROM indices WHERE name = ?", (index_name,)
+            ).fetchone()[0]
+        )
+        if alias not in aliases:
+            aliases.append(alias)
+        self.connection.execute(
+            "UPDATE indices SET aliases = ? WHERE name = ?",
+            (json.dumps(aliases), index_name),
+        )
+        return {"acknowledged": True}
+
+    def put_mapping(self, name, body):
+        index_name = self.get_index(name)
+        mappings = json.loads(
+            self.connection.execute(
+                "SELECT mappings FROM indices WHERE name = ?", (index_name,)
+            ).fetchone()[0]
+        )
+        mappings.setdefault("properties", {}).update((body or {}).get("properties", {}))
+        self.connection.execute(
+            "UPDATE indices SET mappings = ? WHERE name = ?",
+            (json.dumps(mappings), index_name),
+        )
+        return {"acknowledged": True}
+
+    def get_geo_fields(self, index_name):
+        row = self.connection.execute(
+            "SELECT mappings FROM indices WHERE name = ?", (index_name,)
+        ).fetchone()
+        properties = json.loads(row[0]).get("properties", {}) if row else {}
+        return [
+            field
+            for field, mapping in properties.items()
+            if mapping.get("type") in GEO_TYPES
+        ]
+
+    # Documents
+
+    def put_doc(self, index_name, doc_id, source, geo_fields):
+        """
+        Stores the document and indexes the bounds of its geo fields
+        """
+        row = self.connection.execute(
+            "SELECT key FROM docs WHERE idx = ? AND id = ?", (index_name, doc_id)
+        ).fetchone()
+        if row:
+            key = row[0]
+            self.connection.execute(
+                "UPDATE docs SET source = ? WHERE key = ?", (json.dumps(source), key)
+            )
+            self.connection.execute(
+                "DELETE FROM geo_index WHERE key IN (SELECT key FROM geo_keys WHERE doc = ?)",
+                (key,),
+            )
+            self.connection.execute("DELETE FROM geo_keys WHERE doc = ?", (key,))
+        else:
+            key = self.connection.execute(
+                "INSERT INTO docs (idx, id, source) VALUES (?, ?, ?)",
+                (index_name, doc_id, json.dumps(source)),
+            ).lastrowid
+
+        for field in geo_fields:
+            geometry = get_geometry(get_field(source, field))
+            if geometry is None or geometry.is_empty:
+                continue
+            min_x, min_y, max_x, max_y = geometry.bounds
+            geo_key = self.connection.execute(
+                "INSERT INTO geo_keys (doc, field) VALUES (?, ?)", (key, field)
+            ).lastrowid
+            self.connection.execute(
+                "INSERT INTO geo_index VALUES (?, ?, ?, ?, ?)",
+                (geo_key, min_x, max_x, min_y, max_y),
+            )
+
+        return "updated" if row else "created"
+
+    def get_doc(self, index_name, doc_id):
+        row = self.connection.execute(
+            "SELECT source FROM docs WHERE idx = ? AND id = ?", (index_name, doc_id)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def index_doc(self, name, doc_id, source):
+        index_name = self.get_index(name, create=True)
+        doc_id = doc_id or uuid.uuid4().hex
+        result = self.put_doc(index_name, doc_id, source, self.get_geo_fields(index_name))
+        return {"_index": index_name, "_id": doc_id, "result": result}
+
+    def get(self, name, doc_id):
+        index_name = self.get_index(name)
+        source = self.get_doc(index_name, doc_id)
+        if source is None:
+            raise NotFoundError(
+                404, "not_found", {"_index": index_name, "_id": doc_id, "found": False}
+            )
+        return {"_index": index_name, "_id": doc_id, "found": True, "_source": source}
+
+    def mget(self, name, body, params):
+        index_name = self.resolve(name)
+        includes = get_param(params, "_source")
+        ids = body.get("ids") or [doc["_id"] for doc in body.get("docs", [])]
+        docs = []
+        for doc_id in ids:
+            source = self.get_doc(index_name, doc_id) if index_name else None
+            if source is None:
+                docs.append({"_index": name, "_id": doc_id, "found": False})
+            else:
+                docs.append(
+                    {
+                        "_index": index_name,
+                        "_id": doc_id,
+                        "found": True,
+                        "_source": filter_source(source, includes),
+                    }
+                )
+        return {"docs": docs}
+
+    def bulk(self, body):
+        if isinstance(body, bytes):
+            body = body.decode("utf-8")
+        lines = [json.loads(line) for line in body.splitlines() if line.strip()]
+
+        items = []
+        errors = False
+        geo_fields = {}
+        position = 0
+        while position < len(lines):
+            op_type, meta = next(iter(lines[position].items()))
+            position += 1
+            doc_id = meta.get("_id")
+            try:
+                index_name = self.get_index(meta["_index"], create=True)
+                if op_type == "delete":
+                    result = self.delete_doc(index_name, doc_id)
+                    status = 200 if result == "deleted" else 404
+                else:
+                    source = lines[position]
+                    position += 1
+                    if op_type == "update":
+                        current = self.get_doc(index_name, doc_id) or {}
+                        current.update(source.get("doc", {}))
+                        source = current
+                    if index_name not in geo_fields:
+                        geo_fields[index_name] = self.get_geo_fields(index_name)
+                    doc_id = doc_id or uuid.uuid4().hex
+                    result = self.put_doc(
+                        index_name, doc_id, source, geo_fields[index_name]
+                    )
+                    status = 201 if result == "created" else 200
+                items.append(
+                    {
+                        op_type: {
+                            "_index": index_name,
+                            "_id": doc_id,
+                            "status": status,
+                            "result": result,
+                        }
+                    }
+                )
+            except Exception as e:
+                errors = True
+                items.append(
+                    {
+                        op_type: {
+                            "_index": meta.get("_index"),
+                            "_id": doc_id,
+                            "status": 400,
+                            "error": str(e),
+                        }
+                    }
+                )
+
+        return {"took": 0, "errors": errors, "items": items}
+
+    def delete_doc(self, index_name, doc_id):
+        row = self.connection.execute(
+            "SELECT key FROM docs WHERE idx = ? AND id = ?", (index_name, doc_id)
+        ).fetchone()
+        if row is None:
+            return "not_found"
+        self.connection.execute(
+            "DELETE FROM geo_index WHERE key IN (SELECT key FROM geo_keys WHERE doc = ?)",
+            (row[0],),
+        )
+        self.connection.execute("DELETE FROM geo_keys WHERE doc = ?", (row[0],))
+        self.connection.execute("DELETE FROM docs WHERE key = ?", (row[0],))
+        return "deleted"
+
+    # Queries
+
+    def get_candidates(self, index_name, field, geometry):
+        """
+        Returns the keys of the documents whose field bounds intersect
+        the geometry bounds
+        """
+        min_x, min_y, max_x, max_y = geometry.bounds
+        return self.connection.execute(
+            "SELECT docs.key, docs.id, docs.source FROM geo_index"
+            " JOIN geo_keys ON geo_keys.key = geo_index.key"
+            " JOIN docs ON docs.key = geo_keys.doc"
+            " WHERE docs.idx = ? AND geo_keys.field = ?"
+            " AND geo_index.max_x >= ? AND geo_index.min_x <= ?"
+            " AND geo_index.max_y >= ? AND geo_index.min_y <= ?"
+            " ORDER BY docs.key",
+            (index_name, field, min_x, max_x, min_y, max_y),
+        )
+
+    def find(self, index_name, query):
+        """
+        Yields the id and source of the documents matching the query
+        """
+        geo_filter = get_geo_filter(query) if query else None
+        if geo_filter is not None:
+            rows = self.get_candidates(index_name, *geo_filter)
+        else:
+            rows = self.connection.execute(
+                "SELECT key, id, source FROM docs WHERE idx = ? ORDER BY key",
+                (index_name,),
+            )
+        for _, doc_id, source in rows.fetchall():
+            source = json.loads(source)
+            if matches(query, doc_id, source):
+                yield doc_id, source
+
+    def search(self, name, body, params):
+        start = time.time()
+        index_name = self.get_index(name)
+        body = body or {}
+        size = int(get_param(params, "size", body.get("size", 10)))
+        offset = int(get_param(params, "from", body.get("from", 0)))
+        includes = get_param(params, "_source", body.get("_source"))
+
+        found = list(self.find(index_name, body.get("query")))
+        end = offset + size
+        hits = [
+            {
+                "_index": index_name,
+                "_id": doc_id,
+                "_score": None,
+                "_source": filter_source(source, includes),
+            }
+            for doc_id, source in found[offset:end]
+        ]
+        return {
+            "took": int((time.time() - start) * 1000),
+            "timed_out": False,
+            "hits": {
+                "total": {"value": len(found), "relation": "eq"},
+                "max_score": None,
+                "hits": hits,
+            },
+        }
+
+    def count(self, name, body):
+        index_name = self.get_index(name)
+        query = (body or {}).get("query")
+        return {"count": sum(1 for _ in self.find(index_name, query))}
+
+    def delete_by_query(self, name, body):
+        start = time.time()
+        index_name = self.get_index(name)
+        found = list(self.find(index_name, (body or {}).get("query")))
+        for doc_id, _ in found:
+            self.delete_doc(index_name, doc_id)
+        return {
+            "took": int((time.time() - start) * 1000),
+            "timed_out": False,
+            "total": len(found),
+            "deleted": len(found),
+            "failures": [],
+        }
+
+    # Enrich policies and ingest pipelines
+
+    def execute_policy(self, name):
+        """
+        Snapshots the policy source index into its enrich index
+        """
+        policy = self.get_meta("policy", name)
+        if policy is None:
+            raise NotFoundError(
+                404, "resource_not_found_exception", f"policy [{name}] not found"
+            )
+        config = policy["config"]["geo_match"]
+        fields = [config["match_field"]] + config["enrich_fields"]
+
+        enrich_index = ENRICH_PREFIX + name
+        if self.resolve(enrich_index) is not None:
+            self.delete_index(enrich_index)
+        self.create_index(
+            enrich_index,
+            {"mappings": {"properties": {config["match_field"]: {"type": "geo_shape"}}}},
+        )
+
+        source_index = self.get_index(config["indices"])
+        geo_fields = [config["match_field"]]
+        for doc_id, source in list(self.find(source_index, None)):
+            self.put_doc(enrich_index, doc_id, filter_source(source, fields), geo_fields)
+
+        return {"status": {"phase": "COMPLETE"}}
+
+    def get_enrich_matches(self, policy_name, geometry, cache):
+        """
+        Returns the enrich documents whose match field intersects the
+        geometry, in the order they were indexed
+        """
+        config = self.get_meta("policy", policy_name)["config"]["geo_match"]
+        field = config["match_field"]
+        result = []
+        for key, _, source in self.get_candidates(
+            ENRICH_PREFIX + policy_name, field, geometry
+        ).fetchall():
+            if key not in cache:
+                doc = json.loads(source)
+                cache[key] = (doc, prep(get_geometry(doc[field])))
+            doc, prepared = cache[key]
+            if prepared.intersects(geometry):
+                result.append(doc)
+        return result
+
+    def run_enrich(self, options, source, cache):
+        geometry = get_geometry(get_field(source, options["field"]))
+        if geometry is None:
+            if options.get("ignore_missing"):
+                return
+            raise ValueError(f"field [{options['field']}] not present")
+        enrich_matches = self.get_enrich_matches(
+            options["policy_name"], geometry, cache.setdefault(options["policy_name"], {})
+        )
+        max_matches = options.get("max_matches", 1)
+        if enrich_matches:
+            value = [dict(doc) for doc in enrich_matches[:max_matches]]
+            source[options["target_field"]] = value[0] if max_matches == 1 else value
+
+    def run_remove(self, options, source, cache):
+        fields = options["field"]
+        for field in fields if isinstance(fields, list) else [fields]:
+            if not remove_field(source, field) and not options.get("ignore_missing"):
+                raise ValueError(f"field [{field}] not present")
+
+    def run_pipeline(self, pipeline, source, cache):
+        processors = {"enrich": self.run_enrich, "remove": self.run_remove}
+        for processor in pipeline.get("processors", []):
+            op_type, options = next(iter(processor.items()))
+            try:
+                if op_type not in processors:
+                    raise ValueError(f"Unsupported processor [{op_type}]")
+                processors[op_type](options, source, cache)
+            except Exception:
+                if not options.get("ignore_failure"):
+                    raise
+        return source
+
+    def update_by_query(self, name, body, params):
+        """
+        Runs the update by query synchronously, storing a completed task
+        when it was not asked to wait for completion
+        """
+        start = time.time()
+        index_name = self.get_index(name)
+        pipeline_name = get_param(params, "pipeline")
+        pipeline = self.get_meta("pipeline", pipeline_name) if pipeline_name else None
+        if pipeline_name and pipeline is None:
+            raise RequestError(
+                400, "illegal_argument_exception", f"pipeline [{pipeline_name}] not found"
+            )
+
+        geo_fields = self.get_geo_fields(index_name)
+        found = list(self.find(index_name, (body or {}).get("query")))
+        cache = {}
+        failures = []
+        updated = 0
+        for doc_id, source in found:
+            try:
+                if pipeline:
+                    source = self.run_pipeline(pipeline, source, cache)
+                self.put_doc(index_name, doc_id, source, geo_fields)
+                updated += 1
+            except Exception as e:
+                failures.append({"index": index_name, "id": doc_id, "cause": str(e)})
+
+        response = {
+            "took": int((time.time() - start) * 1000),
+            "timed_out": False,
+            "total": len(found),
+            "updated": updated,
+            "deleted": 0,
+            "noops": 0,
+            "failures": failures,
+        }
+
+        if get_param(params, "wait_for_completion", "true") != "false":
+            return response
+
+        task_id = f"{TASK_NODE}:{uuid.uuid4().int % 10 ** 9}"
+        status = {key: response[key] for key in ("total", "updated", "deleted", "noops")}
+        self.put_meta(
+            "task",
+            task_id,
+            {
+                "completed": True,
+                "task": {"id": task_id, "status": status},
+                "response": response,
+            },
+        )
+        return {"task": task_id}
+
+    # Requests
+
+    def perform_request(self, method, url, headers=None, params=None, body=None):
+        """
+        Routes a request of the Elasticsearch client to the local store
+        """
+        parts = [unquote(part) for part in url.strip("/").split("/") if part]
+        with self.lock:
+            try:
+                response = self.route(method, parts, params, body)
+                self.connection.commit()
+                return response
+            except Exception:
+                self.connection.rollback()
+                raise
+
+    def route(self, method, parts, params, body):
+        if isinstance(body, (str, bytes)) and (len(parts) == 0 or parts[-1] != "_bulk"):
+            body = json.loads(body)
+
+        if parts[0] == "_bulk" or parts[-1] == "_bulk":
+            return self.bulk(body)
+
+        handlers = {
+            "_tasks": self.route_task,
+            "_enrich": self.route_policy,
+            "_ingest": self.route_pipeline,
+        }
+        if parts[0] in handlers:
+            return handlers[parts[0]](method, parts, body)
+
+        name = parts[0]
+        if len(parts) == 1:
+            return self.route_index(method, name, params, body)
+
+        handlers = {
+            "_alias": lambda: self.put_alias(name, parts[2]),
+            "_aliases": lambda: self.put_alias(name, parts[2]),
+            "_doc": lambda: self.route_doc(method, name, parts[2:], body),
+            "_create": lambda: self.route_doc(method, name, parts[2:], body),
+            "_mget": lambda: self.mget(name, body, params),
+            "_search": lambda: self.search(name, body, params),
+            "_count": lambda: self.count(name, body),
+            "_update_by_query": lambda: self.update_by_query(name, body, params),
+            "_delete_by_query": lambda: self.delete_by_query(name, body),
+            "_mapping": lambda: self.put_mapping(name, body),
+            "_refresh": lambda: {"_shards": {"failed": 0}},
+        }
+        if parts[1] in handlers:
+            return handlers[parts[1]]()
+
+        raise RequestError(400, "unsupported_operation", f"{method} /{'/'.join(parts)}")
+
+    def route_task(self, method, parts, body):
+        task = self.get_meta("task", parts[1])
+        if task is None:
+            raise NotFoundError(
+                404, "resource_not_found_exception", f"task [{parts[1]}] not found"
+            )
+        return task
+
+    def route_policy(self, method, parts, body):
+        name = parts[2]
+        if len(parts) == 4 and parts[3] == "_execute":
+            return self.execute_policy(name)
+        if method == "PUT":
+            self.put_meta("policy", name, {"config": body})
+            return {"acknowledged": True}
+        if method == "DELETE":
+            self.connection.execute(
+                "DELETE FROM meta WHERE kind = 'policy' AND name = ?", (name,)
+            )
+            return {"acknowledged": True}
+        policy = self.get_meta("policy", name)
+        return {"policies": [policy] if policy else []}
+
+    def route_pipeline(self, method, parts, body):
+        name = parts[2]
+        if method == "PUT":
+            self.put_meta("pipeline", name, body)
+            return {"acknowledged": True}
+        pipeline = self.get_meta("pipeline", name)
+        if pipeline is None:
+            raise NotFoundError(404, "resource_not_found_exception", {})
+        return {name: pipeline}
+
+    def route_index(self, method, name, params, body):
+        if method == "HEAD":
+            return self.resolve(name) is not None
+        if method == "PUT":
+            return self.create_index(name, body)
+        if method == "DELETE":
+            return self.delete_index(name)
+        raise RequestError(400, "unsupported_operation", f"{method} /{name}")
+
+    def route_doc(self, method, name, parts, body):
+        doc_id = parts[0] if parts else None
+        if method == "GET":
+            return self.get(name, doc_id)
+        if method == "HEAD":
+            index_name = self.resolve(name)
+            return index_name is not None and self.get_doc(index_name, doc_id) is not None
+        if method == "DELETE":
+            return {"result": self.delete_doc(self.get_index(name), doc_id)}
+        return self.index_doc(name, doc_id, body)
@@ -11,7 +11,6 @@ from data import download_geojson
 warnings.filterwarnings("ignore")
 logging.getLogger("elasticsearch").setLevel(logging.ERROR)
 
-logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger("app")
 
 INDEX_NAME = "eruptive_pits"
@@ -20,10 +19,10 @@ GEOJSON_URL = (
 )
 
 
-def create_index(client):
+def create_index(client, index_name=INDEX_NAME):
     try:
         client.indices.create(
-            index=INDEX_NAME,
+            index=index_name,
             settings={"number_of_shards": 1, "number_of_replicas": 1},
             mappings={
                 "properties": {
@@ -40,7 +39,7 @@ def create_index(client):
         logger.warning(e.info)
 
 
-def get_actions(features):
+def get_actions(features, index_name=INDEX_NAME):
     for feature in features:
         try:
             properties = feature["properties"]
@@ -49,7 +48,7 @@ def get_actions(features):
             id = properties["OBJECTID"]
 
             yield {
-                "_index": INDEX_NAME,
+                "_index": index_name,
                 "_op_type": "index",
                 "_id": str(id),
                 "_source": {
@@ -62,24 +61,25 @@ def get_actions(features):
             logger.error(f"[{type(e)}] - {e}")
 
 
-def upload_pits(client, overwrite=False):
-    exists = IndicesClient(client).exists(INDEX_NAME)
+def upload_pits(client, overwrite=False, prefix="", url=GEOJSON_URL):
+    index_name = prefix + INDEX_NAME
+    exists = IndicesClient(client).exists(index_name)
     # Creates the pits index or exits
     if exists:
         if overwrite:
             logger.info("Deleting the pits index...")
-            client.indices.delete(index=INDEX_NAME)
+            client.indices.delete(index=index_name)
         else:
             logger.info("Skipping the pits")
             return
 
     logger.info("Creating the pits index...")
-    create_index(client)
+    create_index(client, index_name)
 
     logger.info("Getting the pits data...")
-    features = download_geojson(GEOJSON_URL)
+    features = download_geojson(url)
     logger.debug(f"{len(features)} pits downloaded")
 
     # Bulk upload the records
     logger.info(f"Uploading to ES {len(features)} records...")
-    bulk(client, get_actions(features))
+    bulk(client, get_actions(features, index_name))
@@ -0,0 +1,157 @@
+"""
+Opt-in profiling for the pipeline stages.
+
+Enabled with the PROFILE environment variable or the --profile app
+argument (cpu, memory or all). Stages run under cProfile and/or
+tracemalloc and write a .pstats file and a top allocations report into
+PROFILE_DIR. Hot functions are wrapped with call counters and timers
+only when profiling is enabled, and the profilers are imported on first
+use, so there is no overhead otherwise.
+"""
+import logging
+import os
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+logger = logging.getLogger("app")
+
+MODES = ["cpu", "memory", "all"]
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/profiles")
+TOP_ALLOCATIONS = 25
+
+# Calls and seconds spent on every hooked function
+hook_stats = {}
+
+
+def get_mode(cli_mode=None):
+    """
+    Returns the profiling mode from the CLI or the environment, or None
+    """
+    mode = cli_mode or os.getenv("PROFILE")
+    if mode and mode not in MODES:
+        logger.warning(f"Unknown profiling mode [{mode}], profiling disabled")
+        return None
+    return mode or None
+
+
+def write_allocations(name, snapshot):
+    file_path = os.path.join(PROFILE_DIR, f"{name}.allocations.txt")
+    stats = snapshot.statistics("lineno")
+    with open(file_path, "w") as writer:
+        for stat in stats[:TOP_ALLOCATIONS]:
+            writer.write(f"{stat}\n")
+    logger.info(f"   allocations report: {file_path}")
+
+
+@contextmanager
+def profile(name, mode):
+    """
+    Profiles the wrapped block when a mode is set
+    """
+    if mode is None:
+        yield
+        return
+
+    import cProfile
+    import tracemalloc
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profiler = cProfile.Profile() if mode in ("cpu", "all") else None
+    trace = mode in ("memory", "all")
+
+    if trace:
+        tracemalloc.start()
+    if profiler:
+        profiler.enable()
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if profiler:
+            profiler.disable()
+        logger.info(f"[{name}] profiled in {elapsed:.2f}s")
+
+        if profiler:
+            file_path = os.path.join(PROFILE_DIR, f"{name}.pstats")
+            profiler.dump_stats(file_path)
+            logger.info(f"   cpu profile: {file_path}")
+        if trace:
+            _, peak = tracemalloc.get_traced_memory()
+            write_allocations(name, tracemalloc.take_snapshot())
+            tracemalloc.stop()
+            logger.info(f"   peak memory: {peak / 1024 / 1024:.1f} MB")
+
+
+def timed(name, func):
+    """
+    Wraps a function, or a generator function, adding its calls and
+    elapsed time to the hook stats
+    """
+    import inspect
+
+    stats = hook_stats.setdefault(name, {"calls": 0, "seconds": 0.0})
+
+    if inspect.isgeneratorfunction(func):
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            stats["calls"] += 1
+            generator = func(*args, **kwargs)
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    return
+                finally:
+                    stats["seconds"] += time.perf_counter() - start
+                yield item
+
+    else:
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            stats["calls"] += 1
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats["seconds"] += time.perf_counter() - start
+
+    return wrapper
+
+
+def install_hooks(mode, hooks):
+    """
+    Replaces the (module, function name) hooks by timed versions.
+    Does nothing if profiling is disabled.
+    """
+    if mode is None:
+        return
+
+    for module, func_name in hooks:
+        func = getattr(module, func_name)
+        # Already hooked by a previous stage or region
+        if getattr(func, "profiled", False):
+            continue
+        name = f"{module.__name__}.{func_name}"
+        wrapper = timed(name, func)
+        wrapper.profiled = True
+        setattr(module, func_name, wrapper)
+
+
+def write_hooks_report():
+    if len(hook_stats) == 0:
+        return
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    file_path = os.path.join(PROFILE_DIR, "hooks.txt")
+    with open(file_path, "w") as writer:
+        for name, stats in hook_stats.items():
+            line = f"{name}: {stats['calls']} calls, {stats['seconds']:.3f}s"
+            logger.info(f"   {line}")
+            writer.write(f"{line}\n")
+    logger.info(f"Hooks report: {file_path}")
@@ -0,0 +1,202 @@
+"""
+Geometry validation and repair.
+
+Valid geometries take a fast path: a GEOS validity check and, for
+polygons, a ring orientation check, fixed with a cheap rewind to the
+GeoJSON winding order. Only the invalid ones go through the batched
+repair (make_valid, keeping the polygonal parts, with a buffer(0)
+fallback). Geometries that end up empty or still invalid are dropped.
+Rewinds, repairs and drops are counted per dataset, and the dropped
+feature ids are written to a sidecar report. Callers include the
+region prefix in the dataset name, so parallel regions don't mix.
+"""
+import json
+import logging
+import os
+
+from shapely.geometry import MultiPolygon, Polygon
+from shapely.geometry.polygon import orient
+from shapely.validation import explain_validity, make_valid
+
+logger = logging.getLogger("app")
+
+REPORT_DIR = os.getenv("REPAIR_REPORT_DIR", "/tmp")
+REPORT_FILE = "repair_dropped.json"
+
+# Why a geometry was invalid
+SELF_INTERSECTION = "self-intersection"
+OTHER = "other"
+# Why a repaired geometry was dropped
+EMPTY_RESULT = "empty result"
+STILL_INVALID = "still invalid"
+
+# Counters and dropped features per dataset name, region prefix included
+stats = {}
+dropped = {}
+
+
+def get_counters(name):
+    return stats.setdefault(
+        name,
+        {
+            "geometries": 0,
+            "valid": 0,
+            "reoriented": 0,
+            "repaired": 0,
+            "dropped": 0,
+            "reasons": {SELF_INTERSECTION: 0, OTHER: 0},
+            "results": {EMPTY_RESULT: 0, STILL_INVALID: 0},
+        },
+    )
+
+
+def get_reason(geometry):
+    """
+    Returns the reason why a geometry is invalid and the GEOS explanation
+    """
+    explanation = explain_validity(geometry)
+    if "Self-intersection" in explanation:
+        return SELF_INTERSECTION, explanation
+    return OTHER, explanation
+
+
+def is_oriented(geometry):
+    """
+    Checks the polygons have counterclockwise shells and clockwise holes
+    """
+    if geometry.geom_type == "Polygon":
+        polygons = [geometry]
+    elif geometry.geom_type == "MultiPolygon":
+        polygons = geometry.geoms
+    else:
+        return True
+
+    for polygon in polygons:
+        if polygon.is_empty:
+            continue
+        if not polygon.exterior.is_ccw:
+            return False
+        if any(ring.is_ccw for ring in polygon.interiors):
+            return False
+    return True
+
+
+def orient_polygons(geometry):
+    if geometry.geom_type == "Polygon":
+        return orient(geometry)
+    elif geometry.geom_type == "MultiPolygon":
+        return MultiPolygon([orient(polygon) for polygon in geometry.geoms])
+    return geometry
+
+
+def get_polygonal(geometry):
+    """
+    Returns the polygonal parts of a geometry, as make_valid may
+    return collections with the collapsed parts as lines or points
+    """
+    if geometry.geom_type in ("Polygon", "MultiPolygon"):
+        return geometry
+    polygons = []
+    for part in getattr(geometry, "geoms", []):
+        part = get_polygonal(part)
+        if part.geom_type == "Polygon" and not part.is_empty:
+            polygons.append(part)
+        elif part.geom_type == "MultiPolygon":
+            polygons.extend(part.geoms)
+    if len(polygons) == 1:
+        return polygons[0]
+    return MultiPolygon(polygons) if polygons else Polygon()
+
+
+def repair(geometry):
+    """
+    Returns the repaired polygonal geometry, or None and the reason
+    why it can't be fixed
+    """
+    fixed = get_polygonal(make_valid(geometry))
+    if not fixed.is_valid:
+        logger.debug("Trying to fix the geometry with the buffer trick")
+        fixed = fixed.buffer(0)
+    if fixed.is_empty:
+        return None, EMPTY_RESULT
+    if not fixed.is_valid:
+        return None, STILL_INVALID
+    return orient_polygons(fixed), None
+
+
+def repair_all(geometries, name="geometries", ids=None):
+    """
+    Validates a batch of shapely geometries and repairs the invalid ones.
+    Returns the list of geometries, with None for the dropped ones.
+    """
+    counters = get_counters(name)
+    geometries = list(geometries)
+    ids = list(ids) if ids is not None else list(range(len(geometries)))
+    result = list(geometries)
+
+    # Fast path, only the invalid geometries are repaired
+    invalid = []
+    for idx, geometry in enumerate(geometries):
+        counters["geometries"] += 1
+        if not geometry.is_valid:
+            invalid.append(idx)
+            continue
+        # Valid geometries only need a rewind, as GEOS results usually have
+        # clockwise shells
+        counters["valid"] += 1
+        if not is_oriented(geometry):
+            counters["reoriented"] += 1
+            result[idx] = orient_polygons(geometry)
+
+    for idx in invalid:
+        reason, explanation = get_reason(geometries[idx])
+        counters["reasons"][reason] += 1
+        fixed, result_reason = repair(geometries[idx])
+        if fixed is None:
+            counters["dropped"] += 1
+            counters["results"][result_reason] += 1
+            dropped.setdefault(name, []).append(
+                {
+                    "id": ids[idx],
+                    "reason": reason,
+                    "explanation": explanation,
+                    "result": result_reason,
+                }
+            )
+        else:
+            counters["repaired"] += 1
+        result[idx] = fixed
+
+    return result
+
+
+def log_stats(name):
+    counters = stats.get(name)
+    if not counters or counters["geometries"] == 0:
+        return
+
+    logger.info(f"Validated {counters['geometries']} {name}:")
+    logger.info(f"   valid:      {counters['valid']}")
+    logger.info(f"   reoriented: {counters['reoriented']}")
+    logger.info(f"   repaired:   {counters['repaired']}")
+    logger.info(f"   dropped:    {counters['dropped']}")
+    for reason, count in counters["reasons"].items():
+        if count:
+            logger.info(f"   {reason}: {count}")
+    for result_reason, count in counters["results"].items():
+        if count:
+            logger.info(f"   dropped as {result_reason}: {count}")
+
+
+def write_report():
+    """
+    Writes the dropped feature ids of every dataset
+    """
+    if len(stats) == 0:
+        return
+
+    os.makedirs(REPORT_DIR, exist_ok=True)
+    file_path = os.path.join(REPORT_DIR, REPORT_FILE)
+    with open(file_path, "w") as writer:
+        json.dump({name: dropped.get(name, []) for name in stats}, writer, default=str)
+    logger.info(f"Dropped geometries report: {file_path}")
@@ -0,0 +1,73 @@
+import os
+import subprocess
+import sys
+
+# Measure the app startup with -X importtime. Runs are dry runs, so
+# nothing connects to a cluster even with a .env file.
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+STARTUP_BUDGET_MS = 150
+# Quake-only refreshes also load the elasticsearch client (~150ms)
+QUAKES_BUDGET_MS = 350
+# Best of several runs, to leave out the noise of a busy machine
+RUNS = 5
+HEAVY_MODULES = [
+    "shapely",
+    "numpy",
+    "area",
+    "geojson_rewind",
+    "elasticsearch",
+    "requests_cache",
+]
+# Quake-only refreshes need no geometry libraries
+QUAKES_HEAVY_MODULES = ["shapely", "numpy", "area", "geojson_rewind", "requests_cache"]
+
+
+def get_imports(args, env):
+    """
+    Runs the app and returns the cumulative import time of every top level module
+    """
+    r = subprocess.run(
+        [sys.executable, "-X", "importtime", APP_PATH] + args,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    imports = {}
+    for line in r.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented
+        if not name.startswith("  "):
+            imports[name.strip()] = int(cumulative) / 1000
+    return imports
+
+
+def check(title, args, budget, heavy_modules):
+    runs = [get_imports(args, os.environ.copy()) for _ in range(RUNS)]
+    imports = min(runs, key=lambda i: sum(i.values()))
+    total = sum(imports.values())
+    heavy = [m for m in heavy_modules if m in imports]
+
+    print(f"{title}: {total:.1f}ms (budget {budget}ms)")
+    for name, ms in sorted(imports.items(), key=lambda i: -i[1])[:5]:
+        print(f"   {name}: {ms:.1f}ms")
+
+    errors = []
+    if total > budget:
+        errors.append(f"{title} over budget")
+    if heavy:
+        errors.append(f"{title} imports {', '.join(heavy)}")
+    return errors
+
+
+errors = check("--help", ["--help"], STARTUP_BUDGET_MS, HEAVY_MODULES)
+errors += check(
+    "quakes only",
+    ["--dry-run", "--stages", "earthquakes"],
+    QUAKES_BUDGET_MS,
+    QUAKES_HEAVY_MODULES,
+)
+
+if errors:
+    raise SystemExit("\n".join(errors))
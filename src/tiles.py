@@ -0,0 +1,346 @@
+"""
+Offline vector tiles export.
+
+Builds a Mapbox Vector Tile pyramid per layer (footprints, buildings,
+earthquakes) over the eruption area, written into a directory
+({z}/{x}/{y}.pbf) or an MBTiles SQLite file. Features are clipped and
+simplified per tile. A hash of every exported feature is kept so later
+runs only regenerate the tiles touched by new or changed features.
+The hashes are stored next to the tiles, one state file per format.
+"""
+import json
+import logging
+import math
+import os
+import sqlite3
+import zlib
+
+import numpy as np
+import mapbox_vector_tile
+from shapely.geometry import box, shape
+from shapely.ops import transform
+
+logger = logging.getLogger("app")
+
+TILES_DIR = os.getenv("TILES_DIR", "/tmp/tiles")
+# dir or mbtiles
+TILES_FORMAT = os.getenv("TILES_FORMAT", "dir")
+# Zoom levels of the pyramid, both included
+MIN_ZOOM = int(os.getenv("TILES_MIN_ZOOM", "10"))
+MAX_ZOOM = int(os.getenv("TILES_MAX_ZOOM", "16"))
+ZOOMS = range(MIN_ZOOM, MAX_ZOOM + 1)
+STATE_FILE = "tiles_state_{format}.json"
+
+EXTENT = 4096
+# Tile buffer in tile units, to avoid seams on the clipped edges
+BUFFER = 64
+EARTH_RADIUS = 6378137
+ORIGIN = math.pi * EARTH_RADIUS
+
+
+def to_mercator(lon, lat, z=None):
+    # Any third dimension is dropped
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.clip(np.asarray(lat, dtype=np.float64), -85.0511, 85.0511)
+    x = np.radians(lon) * EARTH_RADIUS
+    y = np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) * EARTH_RADIUS
+    return x, y
+
+
+def tile_bounds(z, x, y):
+    """
+    Web mercator bounds of a XYZ tile
+    """
+    size = 2 * ORIGIN / 2 ** z
+    min_x = -ORIGIN + x * size
+    max_y = ORIGIN - y * size
+    return min_x, max_y - size, min_x + size, max_y
+
+
+def get_tiles(bounds, z):
+    """
+    Returns the XYZ tiles covering web mercator bounds at a zoom level
+    """
+    size = 2 * ORIGIN / 2 ** z
+    last = 2 ** z - 1
+    min_x = min(max(int((bounds[0] + ORIGIN) // size), 0), last)
+    max_x = min(max(int((bounds[2] + ORIGIN) // size), 0), last)
+    min_y = min(max(int((ORIGIN - bounds[3]) // size), 0), last)
+    max_y = min(max(int((ORIGIN - bounds[1]) // size), 0), last)
+    return [
+        (z, x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1)
+    ]
+
+
+def get_properties(properties):
+    """
+    Vector tiles only support scalar properties
+    """
+    result = {}
+    for key, value in properties.items():
+        if isinstance(value, (list, tuple)) and len(value) == 1:
+            value = value[0]
+        if value is None:
+            continue
+        if not isinstance(value, (str, int, float, bool)):
+            value = str(value)
+        result[key] = value
+    return result
+
+
+def get_hash(feature):
+    return zlib.crc32(
+        json.dumps([feature["geometry"], feature["properties"]], default=str).encode("utf-8")
+    )
+
+
+def prepare(features):
+    """
+    Projects the GeoJSON features to web mercator and returns them
+    with their bounds as a NumPy array
+    """
+    prepared = []
+    for feature in features:
+        if not feature.get("geometry"):
+            continue
+        geometry = transform(to_mercator, shape(feature["geometry"]))
+        if geometry.is_empty:
+            continue
+        prepared.append(
+            {
+                "id": feature.get("id", feature["properties"].get("id")),
+                "geometry": geometry,
+                "properties": get_properties(feature["properties"]),
+                "hash": get_hash(feature),
+            }
+        )
+    bounds = np.array([f["geometry"].bounds for f in prepared]).reshape(-1, 4)
+    return prepared, bounds
+
+
+def encode_tile(layer, features, bounds, z, x, y):
+    """
+    Returns the encoded tile with the features clipped and simplified
+    to the tile, or None if empty
+    """
+    t_bounds = tile_bounds(z, x, y)
+    pixel = (t_bounds[2] - t_bounds[0]) / EXTENT
+    margin = BUFFER * pixel
+    clip_box = box(
+        t_bounds[0] - margin, t_bounds[1] - margin, t_bounds[2] + margin, t_bounds[3] + margin
+    )
+
+    candidates = np.nonzero(
+        (bounds[:, 0] <= clip_box.bounds[2])
+        & (bounds[:, 2] >= clip_box.bounds[0])
+        & (bounds[:, 1] <= clip_box.bounds[3])
+        & (bounds[:, 3] >= clip_box.bounds[1])
+    )[0]
+
+    tile_features = []
+    for idx in candidates:
+        feature = features[idx]
+        geometry = feature["geometry"]
+        if geometry.geom_type != "Point":
+            geometry = geometry.intersection(clip_box).simplify(pixel, preserve_topology=True)
+        if geometry.is_empty:
+            continue
+        tile_features.append({"geometry": geometry, "properties": feature["properties"]})
+
+    if len(tile_features) == 0:
+        return None
+
+    return mapbox_vector_tile.encode(
+        [{"name": layer, "features": tile_features}],
+        quantize_bounds=t_bounds,
+        extents=EXTENT,
+    )
+
+
+def get_fields(features):
+    """
+    Returns the vector_layers fields of the prepared features, as the
+    MBTiles metadata types
+    """
+    fields = {}
+    for feature in features:
+        for key, value in feature["properties"].items():
+            if isinstance(value, bool):
+                fields.setdefault(key, "Boolean")
+            elif isinstance(value, (int, float)):
+                fields.setdefault(key, "Number")
+            else:
+                fields.setdefault(key, "String")
+    return fields
+
+
+def get_metadata(layer, features, bbox, zooms):
+    """
+    Returns the MBTiles metadata rows, with the vector_layers json
+    required by the pbf format
+    """
+    min_zoom, max_zoom = min(zooms), max(zooms)
+    vector_layers = [
+        {
+            "id": layer,
+            "fields": get_fields(features),
+            "minzoom": min_zoom,
+            "maxzoom": max_zoom,
+        }
+    ]
+    return [
+        ("name", layer),
+        ("format", "pbf"),
+        ("type", "overlay"),
+        ("minzoom", str(min_zoom)),
+        ("maxzoom", str(max_zoom)),
+        ("bounds", ",".join(str(v) for v in bbox)),
+        ("center", f"{(bbox[0] + bbox[2]) / 2},{(bbox[1] + bbox[3]) / 2},{min_zoom}"),
+        ("json", json.dumps({"vector_layers": vector_layers})),
+    ]
+
+
+def open_mbtiles(path, metadata):
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)"
+    )
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER,"
+        " tile_row INTEGER, tile_data BLOB,"
+        " PRIMARY KEY (zoom_level, tile_column, tile_row))"
+    )
+    connection.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?)", metadata)
+    return connection
+
+
+def write_tile(target, z, x, y, data):
+    """
+    Writes the tile into a directory or a MBTiles connection,
+    removing it if empty
+    """
+    if isinstance(target, sqlite3.Connection):
+        # MBTiles rows follow the TMS scheme
+        row = 2 ** z - 1 - y
+        if data is None:
+            target.execute(
+                "DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                (z, x, row),
+            )
+        else:
+            target.execute(
+                "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)",
+                (z, x, row, sqlite3.Binary(data)),
+            )
+        return
+
+    file_path = os.path.join(target, str(z), str(x), f"{y}.pbf")
+    if data is None:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        return
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, "wb") as writer:
+        writer.write(data)
+
+
+def get_state_path(prefix=""):
+    """
+    Returns the path of the export state, kept with the tiles so it is
+    lost together with them
+    """
+    return os.path.join(TILES_DIR, prefix + STATE_FILE.format(format=TILES_FORMAT))
+
+
+def load_state(prefix=""):
+    try:
+        with open(get_state_path(prefix)) as reader:
+            return json.load(reader)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state, prefix=""):
+    os.makedirs(TILES_DIR, exist_ok=True)
+    with open(get_state_path(prefix), "w") as writer:
+        json.dump(state, writer)
+
+
+def get_touched(exported, bbox, previous=None):
+    """
+    Returns the web mercator bounds of the new, changed and removed
+    features, or the whole bbox when there is no previous export
+    """
+    if previous is None:
+        min_x, min_y = to_mercator(bbox[0], bbox[1])
+        max_x, max_y = to_mercator(bbox[2], bbox[3])
+        return [(min_x, min_y, max_x, max_y)]
+
+    touched = []
+    for id, (f_hash, f_bounds) in exported.items():
+        if id not in previous or previous[id][0] != f_hash:
+            touched.append(f_bounds)
+    # The previous location of changed and removed features
+    for id, (f_hash, f_bounds) in previous.items():
+        if id not in exported or exported[id][0] != f_hash:
+            touched.append(f_bounds)
+    return touched
+
+
+def export_layer(layer, features, bbox, zooms=ZOOMS, prefix="", previous=None):
+    """
+    Regenerates the tiles of a layer touched by new, changed or removed
+    features, or all the tiles over the bbox when there is no previous
+    export. Returns the hash and bounds of the exported features.
+    """
+    prepared, bounds = prepare(features)
+    exported = {
+        str(f["id"]): [f["hash"], b.tolist()] for f, b in zip(prepared, bounds)
+    }
+
+    touched = get_touched(exported, bbox, previous)
+    tiles = set()
+    for z in zooms:
+        for t_bounds in touched:
+            tiles.update(get_tiles(t_bounds, z))
+
+    if len(tiles) == 0:
+        logger.info(f"No {layer} tiles to update")
+        return exported
+
+    if TILES_FORMAT == "mbtiles":
+        os.makedirs(TILES_DIR, exist_ok=True)
+        target = open_mbtiles(
+            os.path.join(TILES_DIR, f"{prefix}{layer}.mbtiles"),
+            get_metadata(layer, prepared, bbox, zooms),
+        )
+    else:
+        target = os.path.join(TILES_DIR, f"{prefix}{layer}")
+
+    logger.info(f"Generating {len(tiles)} {layer} tiles...")
+    for z, x, y in sorted(tiles):
+        write_tile(target, z, x, y, encode_tile(layer, prepared, bounds, z, x, y))
+
+    if isinstance(target, sqlite3.Connection):
+        target.commit()
+        target.close()
+
+    return exported
+
+
+def export_tiles(layers, bbox, zooms=ZOOMS, prefix="", full=False):
+    """
+    Exports a tile pyramid for every layer, given as name and list of
+    GeoJSON features, over the [min_lon, min_lat, max_lon, max_lat] bbox
+    """
+    state = {} if full else load_state(prefix)
+    # Tiles of a previous zoom range can't be updated incrementally
+    if state.get("zooms") != list(zooms):
+        state = {"zooms": list(zooms)}
+
+    for layer, features in layers.items():
+        state[layer] = export_layer(
+            layer, features, bbox, zooms, prefix, state.get(layer)
+        )
+        # Checkpoint after every layer
+        save_state(state, prefix)